@@ -1,7 +1,9 @@
-from django_filters import AllValuesMultipleFilter
+from django.db.models import Exists, OuterRef
 from django_filters.rest_framework import FilterSet, filters
+from rest_framework.filters import OrderingFilter
 
-from recipes.models import Recipe
+from recipes.models import Favorite, Recipe, RecipeTags, ShoppingCart, Tag
+from recipes.search import search_recipes
 from users.models import User
 
 
@@ -11,27 +13,56 @@ class RecipeTagFilter(FilterSet):
         method="in_shopping_cart_method"
     )
     author = filters.ModelChoiceFilter(queryset=User.objects.all())
-    tags = AllValuesMultipleFilter(field_name='tags__slug',
-                                   method='filter_tags')
+    tags = filters.ModelMultipleChoiceFilter(
+        field_name='tags__slug',
+        to_field_name='slug',
+        queryset=Tag.objects.all(),
+        method='filter_tags',
+    )
+    search = filters.CharFilter(method='search_method')
 
+    # Фильтры проверяют связи подзапросом EXISTS, а не JOIN с DISTINCT,
+    # поэтому выборка может идти по индексу на pub_date
     def favorited_method(self, queryset, name, value):
         user = self.request.user
         if value and user.is_authenticated:
-            return queryset.filter(favorite__user=user)
+            return queryset.filter(Exists(Favorite.objects.filter(
+                user=user, recipe=OuterRef('pk'))))
         return queryset.none()
 
     def in_shopping_cart_method(self, queryset, name, value):
         user = self.request.user
         if value and user.is_authenticated:
-            return queryset.filter(shopping_cart__user=user)
+            return queryset.filter(Exists(ShoppingCart.objects.filter(
+                user=user, recipe=OuterRef('pk'))))
         return queryset.none()
 
     def filter_tags(self, queryset, name, value):
         if value:
-            return queryset.filter(
-                tags__slug__in=value).distinct()
+            return queryset.filter(Exists(RecipeTags.objects.filter(
+                recipe=OuterRef('pk'), tag__in=value)))
         return queryset
 
+    def search_method(self, queryset, name, value):
+        return search_recipes(queryset, value)
+
     class Meta:
         model = Recipe
         fields = ("author", "tags")
+
+
+class RecipeOrderingFilter(OrderingFilter):
+    # Результаты поиска по умолчанию идут по релевантности
+    def get_default_ordering(self, view):
+        if view.request.query_params.get('search', '').strip():
+            return ('-search_rank', '-pub_date', '-id')
+        return super().get_default_ordering(view)
+
+    def get_ordering(self, request, queryset, view):
+        # Равные значения различаются по id, как в индексах
+        # recipe_pub_date_id_idx и recipe_favorites_count_idx, иначе
+        # порядок страниц limit/offset не определен
+        ordering = tuple(super().get_ordering(request, queryset, view))
+        if not {'id', '-id', 'pk', '-pk'} & set(ordering):
+            ordering += ('-id' if ordering[0].startswith('-') else 'id',)
+        return ordering
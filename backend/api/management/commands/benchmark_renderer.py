@@ -0,0 +1,56 @@
+import timeit
+from itertools import cycle, islice
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from api.renderers import FastJSONRenderer
+from api.serializers import RECIPE_PREFETCH, RecipeSerializer
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает время рендеринга страницы рецептов стандартным '
+            'JSONRenderer и FastJSONRenderer')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=100,
+                            help='Рецептов на странице')
+        parser.add_argument('--number', type=int, default=200,
+                            help='Рендерингов в одном замере')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        request = Request(APIRequestFactory().get('/api/recipes/'))
+        request.user = AnonymousUser()
+        recipes = list(Recipe.objects.select_related(
+            'author').prefetch_related(*RECIPE_PREFETCH)[:options['size']])
+        if not recipes:
+            raise CommandError('Нет рецептов для страницы')
+        results = RecipeSerializer(
+            recipes, many=True, context={'request': request}).data
+        # Если рецептов меньше, страница добирается повторами
+        data = {
+            'count': options['size'],
+            'next': None,
+            'previous': None,
+            'results': list(islice(cycle(results), options['size'])),
+        }
+        standard, fast = JSONRenderer(), FastJSONRenderer()
+        if standard.render(data) != fast.render(data):
+            raise CommandError('Рендереры выдают разный JSON')
+        timings = {}
+        for renderer in (standard, fast):
+            timings[renderer] = min(timeit.repeat(
+                lambda: renderer.render(data),
+                number=options['number'], repeat=options['repeat'],
+            )) / options['number'] * 1000
+            self.stdout.write(
+                f'{type(renderer).__name__}: {timings[renderer]:.3f} мс '
+                f'на страницу из {options["size"]} рецептов, '
+                f'{len(renderer.render(data))} байт')
+        self.stdout.write(
+            f'Ускорение: {timings[standard] / timings[fast]:.1f}x')
@@ -1,5 +1,172 @@
-from rest_framework.pagination import PageNumberPagination
+import hashlib
+import json
+from base64 import b64decode, b64encode
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.core.paginator import Paginator as DjangoPaginator
+from django.db import connection
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import (BasePagination, CursorPagination,
+                                       LimitOffsetPagination,
+                                       PageNumberPagination, _positive_int)
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from recipes.cache import get_count_version
+
+COUNT_CACHE_KEY = 'count:{label}:{version}:{signature}'
+
+
+def get_estimated_count(sql, params):
+    # Оценка планировщика Postgres без выполнения запроса
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+def get_count_queryset(queryset):
+    # Сортировка и вычисляемые поля (флаги пользователя, релевантность)
+    # не влияют на количество: без них у всех пользователей с одинаковыми
+    # фильтрами один ключ кэша, а COUNT не считает подзапросы EXISTS
+    query = queryset.query.chain()
+    query.clear_ordering(force_empty=True)
+    query.select_related = False
+    query.annotations = {
+        alias: annotation
+        for alias, annotation in query.annotations.items()
+        if annotation.contains_aggregate
+    }
+    query.set_annotation_mask(None)
+    count_queryset = queryset.all()
+    count_queryset.query = query
+    return count_queryset
+
+
+def get_count(queryset):
+    """Количество объектов для пагинации.
+
+    Точное значение кэшируется по тексту запроса количества до изменения
+    модели, а для больших выборок используется оценка планировщика.
+    """
+    queryset = get_count_queryset(queryset)
+    try:
+        sql, params = queryset.query.sql_with_params()
+    except EmptyResultSet:
+        return 0
+    label = queryset.model._meta.label_lower
+    cache_key = COUNT_CACHE_KEY.format(
+        label=label,
+        version=get_count_version(label),
+        signature=hashlib.md5(
+            f'{sql}{params}'.encode()).hexdigest(),
+    )
+    count = cache.get(cache_key)
+    if count is not None:
+        return count
+    threshold = settings.PAGINATION_COUNT_ESTIMATE_THRESHOLD
+    count = None
+    if threshold is not None and connection.vendor == 'postgresql':
+        estimate = get_estimated_count(sql, params)
+        if estimate > threshold:
+            count = estimate
+    if count is None:
+        count = queryset.count()
+    cache.set(cache_key, count, settings.PAGINATION_COUNT_CACHE_TIMEOUT)
+    return count
+
+
+class CachedCountPaginator(DjangoPaginator):
+    @cached_property
+    def count(self):
+        return get_count(self.object_list)
 
 
 class LimitPagination(PageNumberPagination):
     page_size_query_param = "limit"
+    django_paginator_class = CachedCountPaginator
+
+
+class RecipeCursorPagination(CursorPagination):
+    # Ключ страницы - дата публикации, совпадающие даты различаются по id
+    ordering = ('-pub_date', '-id')
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
+
+class RecipePagination(LimitOffsetPagination):
+    # По умолчанию limit/offset, курсорная пагинация включается
+    # параметром pagination=cursor или переданным курсором
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_pagination = None
+        if (request.query_params.get('pagination') == 'cursor'
+                or RecipeCursorPagination.cursor_query_param
+                in request.query_params):
+            self.cursor_pagination = RecipeCursorPagination()
+            return self.cursor_pagination.paginate_queryset(
+                queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_pagination is not None:
+            return self.cursor_pagination.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def get_count(self, queryset):
+        return get_count(queryset)
+
+
+class FeedPagination(BasePagination):
+    """Пагинация ленты подписок по ключу (pub_date, id).
+
+    Страницы выбирает сам RecipeViewSet.feed, здесь только разбор
+    параметров и ссылка на следующую страницу.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    page_size = 6
+    max_page_size = 100
+    invalid_cursor_message = 'Некорректный курсор'
+
+    def get_limit(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size,
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            pub_date, pk = b64decode(
+                encoded.encode('ascii')).decode('ascii').split('|')
+            return datetime.fromisoformat(pub_date), int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, request, position):
+        pub_date, pk = position
+        encoded = b64encode(
+            f'{pub_date.isoformat()}|{pk}'.encode('ascii')).decode('ascii')
+        return replace_query_param(
+            request.build_absolute_uri(), self.cursor_query_param, encoded)
+
+    def get_paginated_response(self, request, data, next_position):
+        return Response({
+            'next': (self.encode_cursor(request, next_position)
+                     if next_position is not None else None),
+            'first': remove_query_param(
+                request.build_absolute_uri(), self.cursor_query_param),
+            'results': data,
+        })
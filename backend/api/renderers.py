@@ -0,0 +1,35 @@
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Символы, которые стандартный рендерер экранирует для вставки в JS
+JS_UNSAFE = ((b'\xe2\x80\xa8', b'\\u2028'), (b'\xe2\x80\xa9', b'\\u2029'))
+
+
+class FastJSONRenderer(JSONRenderer):
+    # Вывод совпадает с JSONRenderer, но сериализация идет через orjson.
+    # Типы, которых orjson не знает (Decimal, ленивые строки переводов
+    # и т.п.), преобразует кодировщик DRF. С отступами и без orjson
+    # работает стандартный рендерер
+    encoder = JSONEncoder()
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or self.get_indent(
+                accepted_media_type, renderer_context or {}):
+            return super().render(
+                data, accepted_media_type, renderer_context)
+        if data is None:
+            return b''
+        ret = orjson.dumps(
+            data,
+            default=self.encoder.default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME,
+        )
+        for char, escaped in JS_UNSAFE:
+            if char in ret:
+                ret = ret.replace(char, escaped)
+        return ret
@@ -1,33 +1,100 @@
 import base64
-
-from django.core.files.base import ContentFile
+import binascii
+import logging
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import (InMemoryUploadedFile,
+                                            TemporaryUploadedFile)
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.db.models import Prefetch, prefetch_related_objects
 from djoser.serializers import UserCreateSerializer, UserSerializer
 from rest_framework import exceptions, serializers
 
 from api.pagination import PageNumberPagination
 from recipes.models import (Favorite, Ingredient, Recipe, RecipeIngredients,
-                            ShoppingCart, Tag)
+                            RecipeTags, ShoppingCart, Tag)
 from users.models import Subscription, User
 
+logger = logging.getLogger(__name__)
+
+# Связи рецепта, которые загружаются заранее для сериализации
+RECIPE_PREFETCH = (
+    'tags',
+    Prefetch(
+        'recipeingredients_set',
+        queryset=RecipeIngredients.objects.select_related('ingredient'),
+    ),
+)
+
 
 class Base64ImageField(serializers.ImageField):
+    # Размер порции base64, кратный 4, чтобы порции декодировались отдельно
+    CHUNK_SIZE = 4 * 64 * 1024
+    # Сигнатуры поддерживаемых форматов изображений
+    SIGNATURES = (
+        (b'\x89PNG\r\n\x1a\n', 'png'),
+        (b'\xff\xd8\xff', 'jpg'),
+        (b'GIF87a', 'gif'),
+        (b'GIF89a', 'gif'),
+    )
+
     def to_internal_value(self, data):
         # Если полученный объект строка, и эта строка
         # начинается с 'data:image'...
         if isinstance(data, str) and data.startswith('data:image'):
-            # начинаем декодировать изображение из base64.
-            # Сначала нужно разделить строку на части.
-            format, imgstr = data.split(';base64,')  # кодировка в base64
-            # И извлечь расширение файла.
-            ext = format.split('/')[-1]
-            # Затем декодировать сами данные и поместить результат в файл,
-            # которому дать название по шаблону.
-            data = ContentFile(base64.b64decode(imgstr), name='temp.' + ext)
-
+            data = self.decode(data)
         return super().to_internal_value(data)
 
+    def decode(self, data):
+        # Декодируем base64 порциями во временный файл, не создавая
+        # копий всей строки, и проверяем размер и заголовок до декодирования
+        start = data.find(';base64,')
+        if start == -1:
+            raise exceptions.ValidationError('Некорректное изображение')
+        start += len(';base64,')
+        size = (len(data) - start) * 3 // 4
+        if size > settings.MAX_IMAGE_UPLOAD_SIZE:
+            raise exceptions.ValidationError(
+                'Размер изображения не может быть больше '
+                f'{settings.MAX_IMAGE_UPLOAD_SIZE // (1024 * 1024)} МБ')
+        if size > settings.FILE_UPLOAD_MAX_MEMORY_SIZE:
+            file = TemporaryUploadedFile('temp', None, size, None)
+        else:
+            file = InMemoryUploadedFile(
+                BytesIO(), None, 'temp', None, size, None)
+        ext = None
+        try:
+            for position in range(start, len(data), self.CHUNK_SIZE):
+                chunk = base64.b64decode(
+                    data[position:position + self.CHUNK_SIZE], validate=True)
+                if ext is None:
+                    ext = self.get_extension(chunk)
+                file.write(chunk)
+        except binascii.Error:
+            file.close()
+            raise exceptions.ValidationError('Некорректное изображение')
+        except exceptions.ValidationError:
+            file.close()
+            raise
+        if ext is None:
+            file.close()
+            raise exceptions.ValidationError('Некорректное изображение')
+        file.name = 'temp.' + ext
+        file.size = file.tell()
+        file.seek(0)
+        return file
+
+    def get_extension(self, header):
+        for signature, ext in self.SIGNATURES:
+            if header.startswith(signature):
+                return ext
+        if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+            return 'webp'
+        raise exceptions.ValidationError('Файл не является изображением')
+
 
 class IngredientSerializer(serializers.ModelSerializer):
     class Meta:
@@ -83,6 +150,10 @@ class CustomUserSerializer(UserSerializer):
                   'last_name', 'is_subscribed')
 
     def get_is_subscribed(self, obj):
+        # Флаг мог быть заранее посчитан в queryset
+        is_subscribed = getattr(obj, 'is_subscribed', None)
+        if is_subscribed is not None:
+            return is_subscribed
         id_user = self.context.get('request').user.id
         return Subscription.objects.filter(
             author=obj.id, user=id_user
@@ -90,8 +161,10 @@ class CustomUserSerializer(UserSerializer):
 
 
 class CreateUpdateRecipeIngredientsSerializer(serializers.ModelSerializer):
+    # Существование ингредиентов проверяется одним запросом
+    # в RecipeCreateUpdateSerializer.validate_ingredients
+    id = serializers.IntegerField()
     # проверка мин.кол-ва ингридиента
-    id = serializers.PrimaryKeyRelatedField(queryset=Ingredient.objects.all())
     amount = serializers.IntegerField(
         validators=(MinValueValidator(1, message='Не может быть меньше 1'),
                     MaxValueValidator(5000, 'Не может быть больше 5000'),)
@@ -108,34 +181,56 @@ class RecipeSerializer(serializers.ModelSerializer):
     ingredients = serializers.SerializerMethodField()
     is_favorited = serializers.SerializerMethodField()
     is_in_shopping_cart = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
 
     def get_ingredients(self, obj):
-        ingredients = RecipeIngredients.objects.filter(recipe=obj)
+        # Используем предзагруженные RecipeViewSet строки с ингредиентами
+        ingredients = obj.recipeingredients_set.all()
         serializer = RecipeIngredientsSerializer(ingredients, many=True)
         return serializer.data
 
+    def get_image_variants(self, obj):
+        # Ссылки на уменьшенные копии фото, пока они не готовы - пусто
+        request = self.context.get('request')
+        return {
+            variant: request.build_absolute_uri(default_storage.url(name))
+            for variant, name in obj.image_variants.items()
+        }
+
     def get_is_favorited(self, obj):
+        # Значение из аннотации RecipeViewSet.get_queryset
+        is_favorited = getattr(obj, 'is_favorited', None)
+        if is_favorited is not None:
+            return is_favorited
         user_id = self.context.get('request').user.id
         return Favorite.objects.filter(user=user_id, recipe=obj.id).exists()
 
     def get_is_in_shopping_cart(self, obj):
+        is_in_shopping_cart = getattr(obj, 'is_in_shopping_cart', None)
+        if is_in_shopping_cart is not None:
+            return is_in_shopping_cart
         user_id = self.context.get('request').user.id
         return ShoppingCart.objects.filter(
             user=user_id, recipe=obj.id
         ).exists()
 
+    def to_representation(self, instance):
+        # Передаем посчитанный флаг подписки во вложенный сериализатор автора
+        author_is_subscribed = getattr(instance, 'author_is_subscribed', None)
+        if author_is_subscribed is not None:
+            instance.author.is_subscribed = author_is_subscribed
+        return super().to_representation(instance)
+
     class Meta:
         model = Recipe
         fields = ('id', 'tags', 'author', 'ingredients', 'is_favorited',
-                  'is_in_shopping_cart', 'name', 'image', 'text',
-                  'cooking_time',)
+                  'is_in_shopping_cart', 'name', 'image', 'image_variants',
+                  'text', 'cooking_time', 'favorites_count',)
 
 
 class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
     author = CustomUserSerializer(read_only=True)
-    tags = serializers.PrimaryKeyRelatedField(
-        queryset=Tag.objects.all(), many=True
-    )
+    tags = serializers.ListField(child=serializers.IntegerField())
     ingredients = CreateUpdateRecipeIngredientsSerializer(many=True)
     image = Base64ImageField()
     image_url = serializers.SerializerMethodField(
@@ -156,6 +251,12 @@ class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
         ingredients_ids = [ingredient['id'] for ingredient in value]
         if len(ingredients_ids) != len(set(ingredients_ids)):
             raise exceptions.ValidationError('Ингрединты повторяются')
+        existing = set(Ingredient.objects.filter(
+            id__in=ingredients_ids).values_list('id', flat=True))
+        missing = [str(pk) for pk in ingredients_ids if pk not in existing]
+        if missing:
+            raise exceptions.ValidationError(
+                f'Ингредиенты не существуют: {", ".join(missing)}')
         return value
 
     # Проверки тегов для рецепта
@@ -165,8 +266,14 @@ class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
         tags = [tag for tag in value]
         if len(set(tags)) != len(tags):
             raise exceptions.ValidationError('Теги в рецепте повторяются')
-        return value
+        existing = Tag.objects.in_bulk(tags)
+        missing = [str(pk) for pk in tags if pk not in existing]
+        if missing:
+            raise exceptions.ValidationError(
+                f'Теги не существуют: {", ".join(missing)}')
+        return [existing[pk] for pk in tags]
 
+    @transaction.atomic
     def create(self, validated_data):
         author = self.context.get('request').user
         # Уберем список из словаря validated_data и сохраним его
@@ -174,26 +281,81 @@ class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
         ingredients = validated_data.pop('ingredients')
         # Создадим новый рецепт пока без инг. и тегов
         recipe = Recipe.objects.create(author=author, **validated_data)
+        self.close_image(validated_data)
         recipe.tags.set(tags)
         self.create_update_ingredients(self, ingredients, recipe)
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         tags = validated_data.pop('tags', None)
-        if tags is not None:
-            instance.tags.set(tags)
-        else:
+        if tags is None:
             raise exceptions.ValidationError('Поле тег в рецепте должно быть')
         ingrs = validated_data.pop('ingredients', None)
-        if ingrs is not None:
-            instance.ingredients.clear()
-            self.create_update_ingredients(
-                self, ingrs, instance)
-        else:
+        if ingrs is None:
             raise exceptions.ValidationError('Поле ингридиент должно быть')
-        return super().update(instance, validated_data)
+        tags_written = self.update_tags(instance, tags)
+        ingredients_written = self.update_ingredients(instance, ingrs)
+        logger.info(
+            'Recipe %s updated: %s tag rows, %s ingredient rows written',
+            instance.pk, tags_written, ingredients_written,
+        )
+        instance = super().update(instance, validated_data)
+        self.close_image(validated_data)
+        return instance
+
+    @staticmethod
+    def close_image(validated_data):
+        # Временный файл с декодированным фото уже перенесен в хранилище
+        image = validated_data.get('image')
+        if image is not None:
+            image.close()
+
+    @staticmethod
+    def update_tags(recipe, tags):
+        # Меняем только добавленные и удаленные теги
+        current = {tag.id for tag in recipe.tags.all()}
+        submitted = {tag.id for tag in tags}
+        removed = current - submitted
+        if removed:
+            RecipeTags.objects.filter(
+                recipe=recipe, tag_id__in=removed).delete()
+        RecipeTags.objects.bulk_create(
+            RecipeTags(recipe=recipe, tag_id=tag_id)
+            for tag_id in submitted - current
+        )
+        return len(removed) + len(submitted - current)
+
+    @staticmethod
+    def update_ingredients(recipe, ingredients):
+        # Сравниваем сохраненные и переданные ингредиенты и пишем
+        # в БД только изменившиеся строки
+        current = {row.ingredient_id: row
+                   for row in recipe.recipeingredients_set.all()}
+        submitted = {ingr['id']: ingr['amount'] for ingr in ingredients}
+        removed = current.keys() - submitted.keys()
+        if removed:
+            RecipeIngredients.objects.filter(
+                recipe=recipe, ingredient_id__in=removed).delete()
+        changed = []
+        for ingredient_id, amount in submitted.items():
+            row = current.get(ingredient_id)
+            if row is not None and row.amount != amount:
+                row.amount = amount
+                changed.append(row)
+        RecipeIngredients.objects.bulk_update(changed, ('amount',))
+        added = [
+            RecipeIngredients(recipe=recipe, ingredient_id=ingredient_id,
+                              amount=amount)
+            for ingredient_id, amount in submitted.items()
+            if ingredient_id not in current
+        ]
+        RecipeIngredients.objects.bulk_create(added)
+        return len(removed) + len(changed) + len(added)
 
     def to_representation(self, instance):
+        # Подгружаем связи одним запросом на каждую, как в RecipeViewSet
+        prefetch_related_objects((instance,), *RECIPE_PREFETCH)
         serializer = RecipeSerializer(
             instance, context={'request': self.context.get('request')}
         )
@@ -209,9 +371,8 @@ class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
         all_recipe_inredients = list()
         for ingr in ingredients:
             amount = ingr.get('amount')
-            ingr_id = get_object_or_404(Ingredient, name=ingr.get('id'))
             recipe_ingreients = RecipeIngredients(recipe=recip,
-                                                  ingredient=ingr_id,
+                                                  ingredient_id=ingr['id'],
                                                   amount=amount)
             all_recipe_inredients.append(recipe_ingreients)
         RecipeIngredients.objects.bulk_create(all_recipe_inredients)
@@ -230,6 +391,8 @@ class SubscriptionSerializer(CustomUserSerializer,
     username = serializers.ReadOnlyField(source="author.username")
     first_name = serializers.ReadOnlyField(source="author.first_name")
     last_name = serializers.ReadOnlyField(source="author.last_name")
+    subscribers_count = serializers.ReadOnlyField(
+        source="author.subscribers_count")
     recipes = serializers.SerializerMethodField()
     recipes_count = serializers.SerializerMethodField()
     is_subscribed = serializers.SerializerMethodField()
@@ -237,11 +400,18 @@ class SubscriptionSerializer(CustomUserSerializer,
     class Meta:
         model = Subscription
         fields = ('email', 'id', 'username', 'first_name', 'last_name',
-                  'is_subscribed', 'recipes', 'recipes_count',)
+                  'is_subscribed', 'recipes', 'recipes_count',
+                  'subscribers_count',)
 
     def get_recipes(self, obj):
-        # список рецептов fатора
-        author_recipes = obj.author.recipes.all()
+        # список рецептов fатора, последние рецепты могли быть
+        # заранее загружены в CustomUserViewSet.subscriptions
+        author_recipes = getattr(obj.author, 'latest_recipes', None)
+        if author_recipes is None:
+            author_recipes = obj.author.recipes.all()
+            recipes_limit = self.context.get('recipes_limit')
+            if recipes_limit is not None:
+                author_recipes = author_recipes[:recipes_limit]
         if author_recipes:
             serializer = RecipeSubscibeSerializer(
                 author_recipes,
@@ -253,4 +423,11 @@ class SubscriptionSerializer(CustomUserSerializer,
 
     def get_recipes_count(self, obj):
         # кол-во рецептов автора
-        return Recipe.objects.filter(author=obj.id).count()
+        recipes_count = getattr(obj, 'recipes_count', None)
+        if recipes_count is not None:
+            return recipes_count
+        return Recipe.objects.filter(author=obj.author_id).count()
+
+    def get_is_subscribed(self, obj):
+        # Сериализуется сама подписка, значит пользователь подписан
+        return True
@@ -0,0 +1,320 @@
+import math
+from fractions import Fraction
+from statistics import median
+
+import numpy as np
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient, APITestCase
+
+from recipes.matching import RecipeIngredientMatrix
+from recipes.similarity import TAG_WEIGHT, RecipeVectors
+from recipes.models import (Favorite, Ingredient, Recipe, RecipeIngredients,
+                            RecipeTags, ShoppingCart, Tag)
+from users.models import Subscription, User
+
+RECIPES = 30
+
+# Запросы на страницу списка рецептов: количество, рецепты, теги,
+# ингредиенты. Флаги пользователя считаются в запросе рецептов
+ANONYMOUS_LIST_QUERIES = 4
+AUTHENTICATED_LIST_QUERIES = 4
+
+
+@override_settings(
+    CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    PAGINATION_COUNT_ESTIMATE_THRESHOLD=None,
+)
+class RecipeListQueriesTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='reader', email='reader@example.com',
+            first_name='Reader', last_name='Reader')
+        authors = [
+            User.objects.create_user(
+                username=f'author{i}', email=f'author{i}@example.com',
+                first_name='Author', last_name=str(i))
+            for i in range(3)
+        ]
+        tags = [Tag.objects.create(name=f'Тег {i}', color='#FFFFFF',
+                                   slug=f'tag{i}') for i in range(3)]
+        ingredients = [Ingredient.objects.create(
+            name=f'Ингредиент {i}', measurement_unit='г') for i in range(5)]
+        image = 'recipes/images/test.png'
+        recipes = [Recipe.objects.create(
+            author=authors[i % len(authors)], name=f'Рецепт {i}',
+            text='Описание', cooking_time=10, image=image,
+            image_variants={'original': image},
+        ) for i in range(RECIPES)]
+        for i, recipe in enumerate(recipes):
+            RecipeTags.objects.create(recipe=recipe, tag=tags[i % 3])
+            RecipeIngredients.objects.bulk_create(
+                RecipeIngredients(recipe=recipe, ingredient=ingredient,
+                                  amount=10)
+                for ingredient in ingredients[i % 3:i % 3 + 3])
+            if i % 2:
+                Favorite.objects.create(user=cls.user, recipe=recipe)
+            if i % 3:
+                ShoppingCart.objects.create(user=cls.user, recipe=recipe)
+        Subscription.objects.create(user=cls.user, author=authors[0])
+
+    def assert_list_queries(self, client, expected):
+        for limit in (5, 25):
+            # Количество и ответы для анонимов не должны браться из кэша
+            cache.clear()
+            with self.subTest(limit=limit), self.assertNumQueries(expected):
+                response = client.get('/api/recipes/', {'limit': limit})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data['results']), limit)
+
+    def test_anonymous_list_queries(self):
+        self.assert_list_queries(APIClient(), ANONYMOUS_LIST_QUERIES)
+
+    def test_authenticated_list_queries(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assert_list_queries(client, AUTHENTICATED_LIST_QUERIES)
+
+    def test_authenticated_flags(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get('/api/recipes/', {'limit': RECIPES})
+        favorited = set(Favorite.objects.filter(
+            user=self.user).values_list('recipe_id', flat=True))
+        in_cart = set(ShoppingCart.objects.filter(
+            user=self.user).values_list('recipe_id', flat=True))
+        for recipe in response.data['results']:
+            self.assertEqual(recipe['is_favorited'], recipe['id'] in favorited)
+            self.assertEqual(recipe['is_in_shopping_cart'],
+                             recipe['id'] in in_cart)
+            self.assertEqual(recipe['author']['is_subscribed'],
+                             recipe['author']['username'] == 'author0')
+
+
+class RecipeBindTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='reader', email='reader@example.com',
+            first_name='Reader', last_name='Reader')
+
+    def test_non_numeric_recipe_id(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        for bind in ('favorite', 'shopping_cart'):
+            with self.subTest(bind=bind):
+                url = f'/api/recipes/abc/{bind}/'
+                self.assertEqual(client.post(url).status_code, 400)
+                self.assertEqual(client.delete(url).status_code, 404)
+
+
+def match_key(matched, total):
+    # Порядок выдачи: доля имеющихся ингредиентов, затем число совпавших
+    return Fraction(matched, total), matched
+
+
+class RecipeMatchingTest(SimpleTestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.recipes = {
+            recipe_id: set(self.rng.choice(
+                np.arange(1, 61), self.rng.integers(1, 12), replace=False
+            ).tolist())
+            for recipe_id in range(1, 401)
+        }
+
+    def build(self):
+        pairs = np.array([
+            (recipe_id, ingredient_id)
+            for recipe_id, ingredients in self.recipes.items()
+            for ingredient_id in ingredients
+        ], dtype=np.int64)
+        return RecipeIngredientMatrix(pairs, timezone.now())
+
+    def expected(self, pantry):
+        # Полный перебор: доля и число совпавших для каждого рецепта
+        return {
+            recipe_id: (len(pantry & ingredients), len(ingredients))
+            for recipe_id, ingredients in self.recipes.items()
+            if pantry & ingredients
+        }
+
+    def assert_matches(self, matrix):
+        for _ in range(200):
+            pantry = set(self.rng.choice(
+                np.arange(1, 66), self.rng.integers(1, 25)).tolist())
+            limit = int(self.rng.integers(1, 30))
+            expected = self.expected(pantry)
+            best = sorted(
+                (match_key(*counts) for counts in expected.values()),
+                reverse=True)
+            with self.subTest(pantry=sorted(pantry), limit=limit):
+                result = matrix.match(sorted(pantry), limit)
+                for recipe_id, matched, total in result:
+                    self.assertEqual(
+                        expected[recipe_id], (matched, total))
+                # Рецепты с равной долей и числом совпадений
+                # взаимозаменяемы, сравниваются только ключи порядка
+                self.assertEqual(
+                    [match_key(*row[1:]) for row in result], best[:limit])
+
+    def test_match(self):
+        self.assert_matches(self.build())
+
+    def test_match_after_update(self):
+        matrix = self.build()
+        changes = {}
+        for recipe_id in self.rng.choice(
+                np.arange(1, 451), 60, replace=False).tolist():
+            ingredients = set(self.rng.choice(
+                np.arange(1, 61), self.rng.integers(0, 8),
+                replace=False).tolist())
+            changes[recipe_id] = ingredients
+            if ingredients:
+                self.recipes[recipe_id] = ingredients
+            else:
+                self.recipes.pop(recipe_id, None)
+        matrix.update(changes)
+        removed = list(self.recipes)[:20]
+        matrix.remove(removed)
+        for recipe_id in removed:
+            del self.recipes[recipe_id]
+        self.assert_matches(matrix)
+
+
+class RecipeSimilarityTest(SimpleTestCase):
+    units = {pk: ('г', 'мл', 'шт')[pk % 3] for pk in range(1, 51)}
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def random_recipe(self, ingredients=40):
+        return (
+            {int(pk): int(self.rng.integers(1, 500)) for pk in
+             self.rng.integers(1, ingredients + 1, self.rng.integers(0, 7))},
+            set(self.rng.integers(1, 6, self.rng.integers(0, 3)).tolist()),
+        )
+
+    @staticmethod
+    def arrays(recipes):
+        ingredients = np.array([
+            (recipe_id, pk, amount)
+            for recipe_id, (amounts, _) in recipes.items()
+            for pk, amount in amounts.items()
+        ], dtype=np.int64).reshape(-1, 3)
+        tags = np.array([
+            (recipe_id, tag_id)
+            for recipe_id, (_, tag_ids) in recipes.items()
+            for tag_id in tag_ids
+        ], dtype=np.int64).reshape(-1, 2)
+        return ingredients, tags
+
+    def brute_vector(self, recipe, scales, frequency, count):
+        # Вектор по определению из RecipeVectors: log(1 + количество /
+        # масштаб единицы) и TAG_WEIGHT, умноженные на IDF, с нормой 1
+        amounts, tag_ids = recipe
+        default_scale = median(scales.values()) if scales else 1.0
+        vector = {}
+        for pk, amount in amounts.items():
+            scale = scales.get(self.units[pk], default_scale)
+            vector[pk * 2] = math.log1p(amount / scale)
+        for tag_id in tag_ids:
+            vector[tag_id * 2 + 1] = TAG_WEIGHT
+        vector = {
+            feature: weight * (math.log(
+                (1 + count) / (1 + frequency.get(feature, 0))) + 1)
+            for feature, weight in vector.items()
+        }
+        norm = math.sqrt(sum(weight ** 2 for weight in vector.values()))
+        return {feature: weight / norm for feature, weight in vector.items()}
+
+    def brute_model(self, recipes):
+        # Масштабы единиц и частоты признаков считаются заново, без кода
+        # RecipeVectors
+        recipes = [recipe for recipe in recipes.values()
+                   if recipe[0] or recipe[1]]
+        by_unit = {}
+        frequency = {}
+        for amounts, tag_ids in recipes:
+            for pk, amount in amounts.items():
+                by_unit.setdefault(self.units[pk], []).append(amount)
+                frequency[pk * 2] = frequency.get(pk * 2, 0) + 1
+            for tag_id in tag_ids:
+                feature = tag_id * 2 + 1
+                frequency[feature] = frequency.get(feature, 0) + 1
+        scales = {unit: max(median(amounts), 1.0)
+                  for unit, amounts in by_unit.items()}
+        return scales, frequency, len(recipes)
+
+    def assert_similar(self, vectors, expected):
+        # expected - recipe_id -> вектор-словарь, посчитанный перебором
+        for recipe_id in self.rng.choice(list(expected), 100).tolist():
+            limit = int(self.rng.integers(1, 15))
+            query = expected[recipe_id]
+            cosines = {
+                other_id: sum(weight * vector.get(feature, 0)
+                              for feature, weight in query.items())
+                for other_id, vector in expected.items()
+                if other_id != recipe_id
+            }
+            best = sorted((cosine for cosine in cosines.values()
+                           if cosine > 1e-12), reverse=True)[:limit]
+            with self.subTest(recipe_id=recipe_id, limit=limit):
+                result = vectors.similar(recipe_id, limit)
+                for other_id, score in result:
+                    self.assertAlmostEqual(score, cosines[other_id])
+                np.testing.assert_allclose(
+                    [score for _, score in result], best)
+
+    def test_similar(self):
+        recipes = {recipe_id: self.random_recipe()
+                   for recipe_id in range(1, 301)}
+        vectors = RecipeVectors.build(
+            *self.arrays(recipes), self.units, timezone.now())
+        model = self.brute_model(recipes)
+        expected = {
+            recipe_id: self.brute_vector(recipe, *model)
+            for recipe_id, recipe in recipes.items()
+            if recipe[0] or recipe[1]
+        }
+        self.assert_similar(vectors, expected)
+        # Измененные рецепты встраиваются с масштабами и IDF построения,
+        # включая ингредиенты, которых при построении не было
+        changes = {}
+        for recipe_id in self.rng.choice(
+                np.arange(1, 321), 40, replace=False).tolist():
+            amounts, tag_ids = self.random_recipe(ingredients=50)
+            if amounts or tag_ids:
+                changes[recipe_id] = vectors.embed(
+                    [(pk, self.units[pk], amount)
+                     for pk, amount in amounts.items()], sorted(tag_ids))
+                expected[recipe_id] = self.brute_vector(
+                    (amounts, tag_ids), *model)
+            else:
+                changes[recipe_id] = None
+                expected.pop(recipe_id, None)
+        vectors.update(changes)
+        self.assert_similar(vectors, expected)
+        self.assert_similar(vectors.compacted(), expected)
+
+    def test_update_after_empty_build(self):
+        vectors = RecipeVectors.build(
+            *self.arrays({}), self.units, timezone.now())
+        self.assertEqual(vectors.similar(1, 10), None)
+        recipes = {recipe_id: self.random_recipe()
+                   for recipe_id in range(1, 51)}
+        recipes = {recipe_id: recipe for recipe_id, recipe in recipes.items()
+                   if recipe[0] or recipe[1]}
+        vectors.update({
+            recipe_id: vectors.embed(
+                [(pk, self.units[pk], amount)
+                 for pk, amount in amounts.items()], sorted(tag_ids))
+            for recipe_id, (amounts, tag_ids) in recipes.items()
+        })
+        # Без построенной базы масштабов нет, а IDF всех признаков - 1
+        expected = {recipe_id: self.brute_vector(recipe, {}, {}, 0)
+                    for recipe_id, recipe in recipes.items()}
+        self.assert_similar(vectors, expected)
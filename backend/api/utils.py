@@ -1,23 +1,39 @@
+import csv
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                patch_vary_headers)
+from django.utils.http import http_date, quote_etag
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfgen.canvas import Canvas
 
+FONT_NAME = 'DejaVuSerif'
+FONT_FILE = 'DejaVuSerif.ttf'
+
+
+def register_fonts():
+    # Разбор TTF-файла выполняется один раз при запуске приложения
+    if FONT_NAME not in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.registerFont(TTFont(FONT_NAME, FONT_FILE))
+
 
 def draw_shopping_cart(response, ingredients):
     begin_position_x, begin_position_y = 30, 730
     canvas = Canvas(response, pagesize=A4)
-    pdfmetrics.registerFont(TTFont('DejaVuSerif', 'DejaVuSerif.ttf'))
-    canvas.setFont('DejaVuSerif', 14)
+    canvas.setFont(FONT_NAME, 14)
     canvas.setTitle('СПИСОК ПОКУПОК')
     canvas.drawString(begin_position_x,
                       begin_position_y + 40, 'Список покупок: ')
-    canvas.setFont('DejaVuSerif', 10)
+    canvas.setFont(FONT_NAME, 10)
     for number, item in enumerate(ingredients, start=1):
         if begin_position_y < 100:
             begin_position_y = 730
             canvas.showPage()
-            canvas.setFont('DejaVuSerif', 12)
+            canvas.setFont(FONT_NAME, 12)
         canvas.drawString(begin_position_x,
                           begin_position_y,
                           f'№{number}: {item["name"]} - '
@@ -26,3 +42,70 @@ def draw_shopping_cart(response, ingredients):
         begin_position_y -= 30
     canvas.showPage()
     canvas.save()
+
+
+class Echo:
+    # Буфер для csv.writer, который сразу отдает записанную строку
+    def write(self, value):
+        return value
+
+
+def stream_shopping_cart_csv(ingredients):
+    writer = csv.writer(Echo())
+    yield writer.writerow(('Ингредиент', 'Количество', 'Единица измерения'))
+    for item in ingredients:
+        yield writer.writerow((item['name'], item['total'], item['unit']))
+
+
+def stream_shopping_cart_txt(ingredients):
+    yield 'Список покупок:\n'
+    for number, item in enumerate(ingredients, start=1):
+        yield f'№{number}: {item["name"]} - {item["total"]}{item["unit"]}\n'
+
+
+def cache_stream(chunks, key):
+    # Отдает части файла и сохраняет его в кэш, если он не слишком большой
+    parts, size = [], 0
+    for chunk in chunks:
+        if parts is not None:
+            size += len(chunk)
+            if size > settings.SHOPPING_CART_CACHE_MAX_SIZE:
+                parts = None
+            else:
+                parts.append(chunk)
+        yield chunk
+    if parts is not None:
+        cache.set(key, ''.join(parts), settings.SHOPPING_CART_CACHE_TIMEOUT)
+
+
+def make_etag(*parts):
+    return quote_etag(hashlib.md5(
+        '|'.join(str(part) for part in parts).encode()).hexdigest())
+
+
+def get_not_modified(request, etag, last_modified=None):
+    # Ответ 304 без сериализации, если у клиента актуальная версия
+    response = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=(int(last_modified.timestamp())
+                       if last_modified is not None else None),
+    )
+    if response is not None:
+        set_cache_headers(request, response, etag, last_modified)
+    return response
+
+
+def set_cache_headers(request, response, etag, last_modified=None):
+    # Анонимные ответы может кэшировать nginx, ответы с флагами
+    # пользователя - только сам клиент с обязательной проверкой
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    if request.user.is_authenticated:
+        patch_cache_control(response, private=True, no_cache=True)
+    else:
+        patch_cache_control(
+            response, public=True, max_age=settings.API_CACHE_MAX_AGE)
+    patch_vary_headers(response, ('Authorization',))
+    return response
@@ -1,26 +1,69 @@
-from django.db.models import F, Sum
-from django.http import HttpResponse
+from datetime import datetime, timezone
+from io import BytesIO
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import (BooleanField, Count, Exists, F, OuterRef,
+                              Prefetch, Q, Subquery, Sum, Value)
+from django.db.models.functions import Collate, Lower
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.http import parse_http_date_safe
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet
 from rest_framework import filters, status, viewsets
 from rest_framework.decorators import action
-from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.permissions import (IsAuthenticated,
                                         IsAuthenticatedOrReadOnly)
 from rest_framework.response import Response
 
-from api.filters import RecipeTagFilter
+from api.filters import RecipeOrderingFilter, RecipeTagFilter
+from api.negotiation import IgnoreFormatContentNegotiation
+from api.pagination import FeedPagination, RecipePagination
 from api.permissions import IsAuthorOrReadOnly
-from api.serializers import (IngredientSerializer,
+from api.serializers import (RECIPE_PREFETCH, IngredientSerializer,
                              RecipeCreateUpdateSerializer, RecipeSerializer,
                              RecipeSubscibeSerializer, SubscriptionSerializer,
                              TagSerializer)
-from api.utils import draw_shopping_cart
+from api.utils import (cache_stream, draw_shopping_cart, get_not_modified,
+                       make_etag, set_cache_headers, stream_shopping_cart_csv,
+                       stream_shopping_cart_txt)
+from recipes.cache import (count_anonymous_response,
+                           get_anonymous_response_key, get_cart_version,
+                           get_catalog_version, get_feed,
+                           get_recipe_list_scopes, set_feed)
+from recipes.catalog import SUBSTRING_MIN_LENGTH, get_ingredient_catalog
+from recipes.matching import get_recipe_matrix
 from recipes.models import (Favorite, Ingredient, Recipe, RecipeIngredients,
                             ShoppingCart, Tag)
+from recipes.similarity import get_recipe_vectors
 from users.models import Subscription, User
 
+# Формат файла: (тип содержимого, генератор потоковой выдачи)
+SHOPPING_CART_FORMATS = {
+    'pdf': ('application/pdf', None),
+    'csv': ('text/csv; charset=utf-8', stream_shopping_cart_csv),
+    'txt': ('text/plain; charset=utf-8', stream_shopping_cart_txt),
+}
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 50
+CAN_MAKE_LIMIT = 10
+CAN_MAKE_MAX_LIMIT = 50
+SIMILAR_LIMIT = 10
+SIMILAR_MAX_LIMIT = 50
+SHOPPING_CART_CACHE_KEY = 'shopping_cart:{user_id}:{file_format}:{version}'
+
+
+def get_recipes_limit(request):
+    # Параметр recipes_limit ограничивает число рецептов в подписках
+    try:
+        recipes_limit = int(request.query_params['recipes_limit'])
+    except (KeyError, ValueError):
+        return None
+    return max(recipes_limit, 0)
+
 
 class CustomUserViewSet(UserViewSet):
     permission_classes = (IsAuthenticatedOrReadOnly,)
@@ -29,7 +72,22 @@ class CustomUserViewSet(UserViewSet):
             permission_classes=(IsAuthenticated,),)
     def subscriptions(self, request):
         user = self.request.user
-        queryset = user.follower.all()
+        recipes_limit = get_recipes_limit(request)
+        # Количество рецептов считается в SQL, а рецепты каждого автора
+        # загружаются одним запросом не больше recipes_limit штук
+        latest_recipes = Recipe.objects.order_by('-pub_date')
+        if recipes_limit is not None:
+            latest_recipes = latest_recipes.filter(pk__in=Subquery(
+                Recipe.objects.filter(
+                    author=OuterRef('author')
+                ).order_by('-pub_date').values('pk')[:recipes_limit]
+            ))
+        queryset = user.follower.select_related('author').annotate(
+            recipes_count=Count('author__recipes'),
+        ).prefetch_related(
+            Prefetch('author__recipes', queryset=latest_recipes,
+                     to_attr='latest_recipes'),
+        ).order_by('id')
         pages = self.paginate_queryset(queryset)
         serializer = SubscriptionSerializer(
             pages, many=True, context={'request': request})
@@ -45,49 +103,241 @@ class CustomUserViewSet(UserViewSet):
                 {'errors': 'Нельзя подписаться на себя'},
                 status=status.HTTP_400_BAD_REQUEST,)
 
-        if Subscription.objects.filter(user=user, author=author).exists():
+        # Счетчик подписчиков меняется сигналом в той же транзакции
+        try:
+            with transaction.atomic():
+                queryset = Subscription.objects.create(
+                    author=author, user=user)
+        except IntegrityError:
             return Response({'errors': 'Подписка уже оформлена'},
                             status=status.HTTP_400_BAD_REQUEST,)
-
-        queryset = Subscription.objects.create(author=author, user=user)
-        serializer = SubscriptionSerializer(queryset,
-                                            context={'request': request})
+        serializer = SubscriptionSerializer(
+            queryset,
+            context={'request': request,
+                     'recipes_limit': get_recipes_limit(request)})
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     @subscribe.mapping.delete
     def delete_subscribe(self, request, id=None):
         user = self.request.user
         author = get_object_or_404(User, pk=id)
-        if not Subscription.objects.filter(
-                user=user, author=author).exists():
+        deleted, _ = Subscription.objects.filter(
+            user=user, author=author).delete()
+        if not deleted:
             return Response({'errors': 'Вы уже отписаны'},
                             status=status.HTTP_400_BAD_REQUEST,)
-        subscription = get_object_or_404(Subscription,
-                                         user=user, author=author)
-        subscription.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class TagViewSet(viewsets.ReadOnlyModelViewSet):
+class CatalogConditionalMixin:
+    # Ответы справочников меняются только вместе с версией каталога,
+    # поэтому повторный запрос с If-None-Match получает 304
+    def conditional(self, request, view, *args, **kwargs):
+        etag = make_etag(get_catalog_version(), request.get_full_path())
+        response = get_not_modified(request, etag)
+        if response is None:
+            response = view(request, *args, **kwargs)
+            set_cache_headers(request, response, etag)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(request, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(
+            request, super().retrieve, *args, **kwargs)
+
+
+class TagViewSet(CatalogConditionalMixin, viewsets.ReadOnlyModelViewSet):
     pagination_class = None
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
 
 
-class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
+class IngredientViewSet(CatalogConditionalMixin,
+                        viewsets.ReadOnlyModelViewSet):
     pagination_class = None
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     filter_backends = (filters.SearchFilter,)
     search_fields = ('^name',)
 
+    def list(self, request, *args, **kwargs):
+        if not settings.INGREDIENT_CATALOG_IN_MEMORY:
+            return super().list(request, *args, **kwargs)
+        return self.conditional(request, self.list_from_catalog)
+
+    def list_from_catalog(self, request):
+        # Поиск по началу названия, как у SearchFilter с ^name
+        return Response(get_ingredient_catalog().startswith(
+            request.query_params.get('name', '').strip()))
+
+    def retrieve(self, request, *args, **kwargs):
+        if not settings.INGREDIENT_CATALOG_IN_MEMORY:
+            return super().retrieve(request, *args, **kwargs)
+        return self.conditional(request, self.retrieve_from_catalog, **kwargs)
+
+    def retrieve_from_catalog(self, request, pk):
+        try:
+            ingredient = get_ingredient_catalog().get(int(pk))
+        except ValueError:
+            ingredient = None
+        if ingredient is None:
+            raise Http404
+        return Response(ingredient)
+
+    @action(detail=False, methods=('get',), filter_backends=())
+    def autocomplete(self, request):
+        return self.conditional(request, self.search)
+
+    def search(self, request):
+        # Сначала совпадения по началу названия (по индексу
+        # ingredient_name_prefix_idx), затем по вхождению подстроки
+        # (по триграммному индексу ingredient_name_trgm_idx, который
+        # работает только для строк от трех символов)
+        name = request.query_params.get('name', '').strip().lower()
+        try:
+            limit = min(int(request.query_params.get(
+                'limit', AUTOCOMPLETE_LIMIT)), AUTOCOMPLETE_MAX_LIMIT)
+        except ValueError:
+            limit = AUTOCOMPLETE_LIMIT
+        if not name or limit < 1:
+            return Response([])
+        if settings.INGREDIENT_CATALOG_IN_MEMORY:
+            return Response(get_ingredient_catalog().search(name, limit))
+        queryset = Ingredient.objects.annotate(
+            name_lower=Collate(Lower('name'), 'C')).order_by('name_lower')
+        ingredients = list(
+            queryset.filter(name_lower__startswith=name)[:limit])
+        if len(ingredients) < limit and len(name) >= SUBSTRING_MIN_LENGTH:
+            ingredients += queryset.filter(
+                name_lower__contains=name
+            ).exclude(
+                name_lower__startswith=name
+            )[:limit - len(ingredients)]
+        serializer = self.get_serializer(ingredients, many=True)
+        return Response(serializer.data)
+
 
 class RecipeViewSet(viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     permission_classes = (IsAuthorOrReadOnly,)
-    filter_backends = (DjangoFilterBackend,)
+    filter_backends = (DjangoFilterBackend, RecipeOrderingFilter)
     filterset_class = RecipeTagFilter
-    pagination_class = LimitOffsetPagination
+    # ?ordering=-favorites_count - сортировка по популярности,
+    # ?search= - полнотекстовый поиск с сортировкой по релевантности
+    ordering_fields = ('pub_date', 'favorites_count')
+    ordering = ('-pub_date', '-id')
+    pagination_class = RecipePagination
+
+    def get_queryset(self):
+        # Автор, теги и ингредиенты загружаются заранее
+        return self.annotate_flags(
+            Recipe.objects.select_related('author').prefetch_related(
+                *RECIPE_PREFETCH)
+        )
+
+    def annotate_flags(self, queryset):
+        # Флаги избранного, списка покупок и подписки считаются
+        # подзапросами EXISTS в одном запросе на всю страницу
+        user = self.request.user
+        if not user.is_authenticated:
+            false = Value(False, output_field=BooleanField())
+            return queryset.annotate(
+                is_favorited=false,
+                is_in_shopping_cart=false,
+                author_is_subscribed=false,
+            )
+        return queryset.annotate(
+            is_favorited=Exists(Favorite.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            is_in_shopping_cart=Exists(ShoppingCart.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            author_is_subscribed=Exists(Subscription.objects.filter(
+                user=user, author=OuterRef('author'))),
+        )
+
+    def list(self, request, *args, **kwargs):
+        if request.user.is_authenticated:
+            return super().list(request, *args, **kwargs)
+        author = request.query_params.get('author', '')
+        scopes = get_recipe_list_scopes(
+            int(author) if author.isdigit() else None,
+            request.query_params.getlist('tags'),
+        )
+        return self.get_anonymous_response(
+            request, scopes, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = str(kwargs['pk'])
+        if request.user.is_authenticated or not pk.isdigit():
+            return self.retrieve_conditional(request, *args, **kwargs)
+        return self.get_anonymous_response(
+            request, (f'recipe:{int(pk)}',), self.retrieve_conditional,
+            *args, **kwargs)
+
+    def get_anonymous_response(self, request, scopes, view, *args, **kwargs):
+        # Для анонимов флаги всегда ложные и ответ одинаков для всех,
+        # поэтому данные хранятся в кэше до смены версии областей
+        # (recipes.signals), от которых зависит ответ
+        params = urlencode(sorted(
+            (key, sorted(values))
+            for key, values in request.query_params.lists()
+        ), doseq=True)
+        key = get_anonymous_response_key(
+            scopes, f'{request.get_host()}{request.path}?{params}')
+        cached = cache.get(key)
+        count_anonymous_response(cached is not None)
+        if cached is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code == status.HTTP_200_OK:
+                if not response.has_header('ETag'):
+                    set_cache_headers(request, response, make_etag(key))
+                cache.set(key, (
+                    response.data, response['ETag'],
+                    parse_http_date_safe(response.get('Last-Modified')),
+                ), settings.ANONYMOUS_RECIPES_CACHE_TIMEOUT)
+            response['X-Response-Cache'] = 'MISS'
+            return response
+        data, etag, last_modified = cached
+        if last_modified is not None:
+            last_modified = datetime.fromtimestamp(last_modified, timezone.utc)
+        response = get_not_modified(request, etag, last_modified)
+        if response is None:
+            response = set_cache_headers(
+                request, Response(data), etag, last_modified)
+        response['X-Response-Cache'] = 'HIT'
+        return response
+
+    def retrieve_conditional(self, request, *args, **kwargs):
+        # ETag строится по легкому запросу без сериализации рецепта:
+        # дата изменения, счетчик, данные автора и флаги текущего
+        # пользователя
+        try:
+            state = self.annotate_flags(
+                Recipe.objects.filter(pk=kwargs['pk'])
+            ).values(
+                'updated_at', 'favorites_count', 'is_favorited',
+                'is_in_shopping_cart', 'author_is_subscribed',
+                'author__email', 'author__username', 'author__first_name',
+                'author__last_name', 'author__updated_at',
+            ).first()
+        except (TypeError, ValueError):
+            state = None
+        if state is None:
+            raise Http404
+        etag = make_etag(kwargs['pk'], get_catalog_version(),
+                         *state.values())
+        # Дата изменения не учитывает флаги пользователя, поэтому
+        # Last-Modified отдается только анонимам
+        last_modified = (None if request.user.is_authenticated
+                         else max(state['updated_at'],
+                                  state['author__updated_at']))
+        response = get_not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+        response = super().retrieve(request, *args, **kwargs)
+        return set_cache_headers(request, response, etag, last_modified)
 
     def get_serializer_class(self):
         if self.action in ('create', 'partial_update', 'update'):
@@ -96,30 +346,33 @@ class RecipeViewSet(viewsets.ModelViewSet):
         return RecipeSerializer
 
     def add_bind(self, model, user, pk, name):
-        try:
-            # recipe = get_object_or_404(Recipe, pk=pk)
-            recipe = Recipe.objects.get(pk=pk)
-            bind = model.objects.filter(user=user, recipe=recipe)
-            if bind.exists():
-                return Response(
-                    {'errors': f'Нельзя повторно добавить рецепт в {name}'},
-                    status=status.HTTP_400_BAD_REQUEST,)
-            model.objects.create(user=user, recipe=recipe)
-            serializer = RecipeSubscibeSerializer(recipe)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-        except Exception:
+        # Нечисловой id - такой же несуществующий рецепт, а не ошибка 500
+        recipe = Recipe.objects.filter(pk=pk).first() if pk.isdigit() else None
+        if recipe is None:
             return Response({'errors': 'Такого рецепта не существует'},
                             status=status.HTTP_400_BAD_REQUEST,)
+        # Повторное добавление отсекает уникальное ограничение в БД,
+        # счетчик рецепта меняется сигналом в той же транзакции
+        try:
+            with transaction.atomic():
+                model.objects.create(user=user, recipe=recipe)
+        except IntegrityError:
+            return Response(
+                {'errors': f'Нельзя повторно добавить рецепт в {name}'},
+                status=status.HTTP_400_BAD_REQUEST,)
+        serializer = RecipeSubscibeSerializer(recipe)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def delete_bind(self, model, user, pk, name):
-        recipe = get_object_or_404(Recipe, pk=pk)
-        bind = model.objects.filter(user=user, recipe=recipe)
-        if not bind.exists():
+        if not pk.isdigit():
+            raise Http404
+        deleted, _ = model.objects.filter(user=user, recipe_id=pk).delete()
+        if not deleted:
+            get_object_or_404(Recipe, pk=pk)
             return Response(
                 {'errors': f'Нельзя повторно удалить рецепт из {name}'},
                 status=status.HTTP_400_BAD_REQUEST,
             )
-        bind.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(
@@ -154,23 +407,154 @@ class RecipeViewSet(viewsets.ModelViewSet):
             return self.delete_bind(ShoppingCart, user, pk, name)
         return Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
+    def get_feed_queryset(self, user):
+        return Recipe.objects.filter(
+            author__in=user.follower.values('author')
+        ).order_by('-pub_date', '-id')
+
+    @action(detail=False, methods=('get',),
+            permission_classes=(IsAuthenticated,))
+    def feed(self, request):
+        # Лента рецептов авторов из подписок. Ключи последних рецептов
+        # хранятся в кэше и дополняются при публикации (recipes.signals),
+        # в БД идем только за страницами глубже закэшированной части
+        user = request.user
+        paginator = FeedPagination()
+        limit = paginator.get_limit(request)
+        position = paginator.decode_cursor(request)
+        feed = get_feed(user.id)
+        if feed is None:
+            entries = list(self.get_feed_queryset(user).values_list(
+                'pub_date', 'id')[:settings.FEED_CACHE_SIZE])
+            feed = set_feed(user.id, entries)
+        entries = [entry for entry in feed['entries']
+                   if position is None or entry < position]
+        if len(entries) <= limit and not feed['complete']:
+            queryset = self.get_feed_queryset(user)
+            if position is not None:
+                pub_date, pk = position
+                queryset = queryset.filter(
+                    Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, id__lt=pk))
+            entries = list(
+                queryset.values_list('pub_date', 'id')[:limit + 1])
+        page = entries[:limit]
+        recipes = self.get_queryset().in_bulk([pk for _, pk in page])
+        serializer = self.get_serializer(
+            [recipes[pk] for _, pk in page if pk in recipes], many=True)
+        return paginator.get_paginated_response(
+            request, serializer.data,
+            page[-1] if len(entries) > limit else None)
+
+    def load_matches(self, index, search):
+        # Рецепты по результатам поиска в памяти воркера. Удаленные
+        # рецепты убираются из индекса при первой встрече
+        while True:
+            matches = search()
+            recipes = self.get_queryset().in_bulk(
+                [match[0] for match in matches])
+            deleted = [match[0] for match in matches
+                       if match[0] not in recipes]
+            if not deleted:
+                return [(recipes[match[0]], match) for match in matches]
+            index.remove(deleted)
+
+    @action(detail=False, methods=('get',), url_path='can_make',
+            url_name='can_make')
+    def can_make(self, request):
+        # Рецепты, для которых хватает ингредиентов из запроса: доля
+        # имеющихся ингредиентов считается по матрице в памяти за один
+        # проход, из БД читаются только найденные рецепты
+        try:
+            ingredient_ids = [
+                int(value)
+                for param in request.query_params.getlist('ingredients')
+                for value in param.split(',') if value.strip()
+            ]
+            limit = min(int(request.query_params.get(
+                'limit', CAN_MAKE_LIMIT)), CAN_MAKE_MAX_LIMIT)
+        except ValueError:
+            return Response(
+                {'errors': 'Ингредиенты и limit должны быть числами'},
+                status=status.HTTP_400_BAD_REQUEST,)
+        if not ingredient_ids or limit < 1:
+            return Response([])
+        matrix = get_recipe_matrix()
+        found = self.load_matches(
+            matrix, lambda: matrix.match(ingredient_ids, limit))
+        data = self.get_serializer(
+            [recipe for recipe, _ in found], many=True).data
+        for item, (_, (_, matched, total)) in zip(data, found):
+            item['matched_ingredients'] = matched
+            item['total_ingredients'] = total
+        return Response(data)
+
+    @action(detail=True, methods=('get',), url_path='similar',
+            url_name='similar')
+    def similar(self, request, pk=None):
+        # Близкие рецепты по косинусу векторов ингредиентов и тегов
+        try:
+            recipe_id = int(pk)
+            limit = min(int(request.query_params.get(
+                'limit', SIMILAR_LIMIT)), SIMILAR_MAX_LIMIT)
+        except ValueError:
+            raise Http404
+        if not Recipe.objects.filter(pk=recipe_id).exists():
+            raise Http404
+        vectors = get_recipe_vectors()
+        # Вектора нет у рецепта без ингредиентов и тегов
+        if limit < 1 or vectors.vector(recipe_id) is None:
+            return Response([])
+        found = self.load_matches(
+            vectors, lambda: vectors.similar(recipe_id, limit) or [])
+        data = self.get_serializer(
+            [recipe for recipe, _ in found], many=True).data
+        for item, (_, (_, similarity)) in zip(data, found):
+            item['similarity'] = round(similarity, 4)
+        return Response(data)
+
     @action(
         detail=False,
         methods=('get',),
         permission_classes=(IsAuthenticated,),
+        content_negotiation_class=IgnoreFormatContentNegotiation,
         url_path='download_shopping_cart',
         url_name='download_shopping_cart',
     )
     def download_shopping_cart(self, request):
+        file_format = request.query_params.get('format', 'pdf')
+        if file_format not in SHOPPING_CART_FORMATS:
+            return Response(
+                {'errors': 'Доступные форматы: '
+                           f'{", ".join(SHOPPING_CART_FORMATS)}'},
+                status=status.HTTP_400_BAD_REQUEST,)
         ingredients = RecipeIngredients.objects.filter(
             recipe__shopping_cart__user=request.user).values(
             name=F('ingredient__name'),
             unit=F('ingredient__measurement_unit')
         ).order_by('name').annotate(total=Sum('amount'))
 
-        response = HttpResponse(
-            content_type='application/pdf')
+        content_type, stream = SHOPPING_CART_FORMATS[file_format]
+        # Готовый файл хранится в кэше, пока не изменится версия списка
+        cache_key = SHOPPING_CART_CACHE_KEY.format(
+            user_id=request.user.id,
+            file_format=file_format,
+            version=get_cart_version(request.user.id),
+        )
+        content = cache.get(cache_key)
+        if content is not None:
+            response = HttpResponse(content, content_type=content_type)
+        elif stream is None:
+            buffer = BytesIO()
+            draw_shopping_cart(buffer, ingredients)
+            content = buffer.getvalue()
+            cache.set(cache_key, content, settings.SHOPPING_CART_CACHE_TIMEOUT)
+            response = HttpResponse(content, content_type=content_type)
+        else:
+            # Строки отдаются по мере чтения из курсора БД
+            response = StreamingHttpResponse(
+                cache_stream(stream(ingredients.iterator()), cache_key),
+                content_type=content_type,
+            )
         response['Content-Disposition'] = (
-            'attachment; filename="shopping-list.pdf"')
-        draw_shopping_cart(response, ingredients)
+            f'attachment; filename="shopping-list.{file_format}"')
         return response
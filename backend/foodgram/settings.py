@@ -44,6 +44,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework.authtoken',
     'rest_framework',
     'django_filters',
@@ -158,6 +159,115 @@ MEDIA_ROOT = '/media/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Кэш общий для всех воркеров: версии, списки покупок, ленты, ответы
+# для анонимов и счетчики. memcached вытесняет давно не использованные
+# ключи и атомарно выполняет incr. Без MEMCACHED_LOCATION (локальный
+# запуск) используется файловый кэш с лимитом под ключи пользователей:
+# при превышении он просматривает весь каталог и удаляет часть записей
+if os.getenv('MEMCACHED_LOCATION'):
+    CACHES = {
+        'default': {
+            'BACKEND':
+                'django.core.cache.backends.memcached.PyMemcacheCache',
+            'LOCATION': os.getenv('MEMCACHED_LOCATION'),
+            'OPTIONS': {
+                'no_delay': True,
+                # Недоступный memcached - промах кэша, а не ошибка 500
+                'ignore_exc': True,
+                'use_pooling': True,
+                'max_pool_size': 8,
+            },
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.getenv('CACHE_LOCATION', '/tmp/foodgram_cache'),
+            'OPTIONS': {
+                'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', 50000)),
+                'CULL_FREQUENCY': 10,
+            },
+        }
+    }
+
+# Сообщения приложений (в том числе число строк, записанных при
+# обновлении рецепта) выводятся в stdout контейнера
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'default': {
+            'format': '%(asctime)s %(levelname)s %(name)s %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'default',
+        },
+    },
+    'loggers': {
+        'api': {
+            'handlers': ['console'],
+            'level': os.getenv('APP_LOG_LEVEL', 'INFO'),
+        },
+        'recipes': {
+            'handlers': ['console'],
+            'level': os.getenv('APP_LOG_LEVEL', 'INFO'),
+        },
+    },
+}
+
+# Время жизни и максимальный размер списка покупок в кэше
+SHOPPING_CART_CACHE_TIMEOUT = 60 * 60
+SHOPPING_CART_CACHE_MAX_SIZE = 1024 * 1024
+
+# Максимальный размер фото рецепта, присланного в base64
+MAX_IMAGE_UPLOAD_SIZE = int(
+    os.getenv('MAX_IMAGE_UPLOAD_SIZE', 10 * 1024 * 1024))
+
+# Кэш количества объектов в пагинации: время жизни и порог, выше
+# которого используется оценка планировщика Postgres (None - всегда точно)
+PAGINATION_COUNT_CACHE_TIMEOUT = 60
+PAGINATION_COUNT_ESTIMATE_THRESHOLD = 10000
+
+# Лента рецептов из подписок: сколько последних рецептов хранится
+# в кэше для каждого пользователя и как долго
+FEED_CACHE_SIZE = 200
+FEED_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Сколько секунд nginx и клиенты могут хранить анонимные ответы API
+API_CACHE_MAX_AGE = 60
+
+# Кэш ответов со списком и карточками рецептов для анонимов. Записи
+# сбрасываются сигналами, только счетчик избранного в списках может
+# отставать на это время
+ANONYMOUS_RECIPES_CACHE_TIMEOUT = 60 * 5
+
+# Каталог колоночного снимка для аналитики (export_snapshot)
+ANALYTICS_SNAPSHOT_DIR = os.getenv(
+    'ANALYTICS_SNAPSHOT_DIR', BASE_DIR / 'snapshot')
+# Рецепты моложе этого числа секунд не выгружаются: дата публикации
+# ставится до фиксации транзакции, и более ранний рецепт может стать
+# виден позже уже выгруженного
+ANALYTICS_SNAPSHOT_DELAY = int(os.getenv('ANALYTICS_SNAPSHOT_DELAY', 300))
+
+# Фоновая подготовка уменьшенных копий фото рецептов
+IMAGE_PROCESSING_ASYNC = True
+IMAGE_PROCESSING_WORKERS = int(os.getenv('IMAGE_PROCESSING_WORKERS', 2))
+
+# Поиск ингредиентов по справочнику в памяти воркера вместо запросов к БД
+INGREDIENT_CATALOG_IN_MEMORY = (
+    os.getenv('INGREDIENT_CATALOG_IN_MEMORY', 'False') == 'True')
+
+# Сколько измененных рецептов матрица рецепт x ингредиент и векторы
+# похожих рецептов держат поверх основной части до перестройки
+RECIPE_MATRIX_MAX_CHANGES = 1000
+
+# Конфигурация полнотекстового поиска PostgreSQL для рецептов
+RECIPE_SEARCH_CONFIG = 'russian'
+
 AUTH_USER_MODEL = 'users.User'
 
 REST_FRAMEWORK = {
@@ -169,6 +279,16 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.TokenAuthentication',
     ],
     # 'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    # JSON через orjson, если он установлен
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'api.parsers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     "SEARCH_PARAM": "name",
     "DEFAULT_PAGINATION_CLASS": "api.pagination.LimitPagination",
     'PAGE_SIZE': 6,
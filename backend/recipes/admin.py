@@ -1,6 +1,7 @@
 from django.contrib import admin
 
 from .models import Ingredient, Recipe, Tag
+from .signals import bump_recipe_carts
 
 
 class RecipeIngredientsInLine(admin.TabularInline):
@@ -15,11 +16,18 @@ class RecipeTagsInLine(admin.TabularInline):
 
 @admin.register(Recipe)
 class RecipeAdmin(admin.ModelAdmin):
-    list_display = ("id", "name", "text", "pub_date", "author")
+    list_display = ("id", "name", "text", "pub_date", "author",
+                    "favorites_count", "shopping_cart_count")
     search_fields = ("name", "author")
     inlines = (RecipeIngredientsInLine, RecipeTagsInLine)
     empty_value_display = "-пусто-"
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Ингредиенты сохраняются после рецепта, сбрасываем списки покупок
+        if change:
+            bump_recipe_carts(form.instance.pk)
+
 
 @admin.register(Ingredient)
 class IngredientAdmin(admin.ModelAdmin):
@@ -0,0 +1,190 @@
+from hashlib import md5
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Recipe, Tag
+
+CART_VERSION_KEY = 'shopping_cart_version:{user_id}'
+
+
+def get_cart_version(user_id):
+    # Версия списка покупок пользователя, меняется при любом его изменении
+    return cache.get_or_set(
+        CART_VERSION_KEY.format(user_id=user_id), lambda: uuid4().hex, None)
+
+
+def bump_cart_versions(user_ids):
+    cache.set_many(
+        {CART_VERSION_KEY.format(user_id=user_id): uuid4().hex
+         for user_id in user_ids},
+        None,
+    )
+
+
+CATALOG_VERSION_KEY = 'catalog_version'
+
+
+def get_catalog_version():
+    # Версия справочников ингредиентов и тегов, меняется при импорте
+    # и в админке
+    return cache.get_or_set(CATALOG_VERSION_KEY, lambda: uuid4().hex, None)
+
+
+def bump_catalog_version():
+    cache.set(CATALOG_VERSION_KEY, uuid4().hex, None)
+
+
+RECIPE_MATRIX_VERSION_KEY = 'recipe_matrix_version'
+
+
+def get_recipe_matrix_version():
+    # Версия состава рецептов для матрицы рецепт x ингредиент
+    return cache.get_or_set(
+        RECIPE_MATRIX_VERSION_KEY, lambda: uuid4().hex, None)
+
+
+def bump_recipe_matrix_version():
+    cache.set(RECIPE_MATRIX_VERSION_KEY, uuid4().hex, None)
+
+
+COUNT_VERSION_KEY = 'count_version:{label}'
+
+
+def get_count_version(label):
+    # Версия количества объектов модели для кэша счетчиков пагинации
+    return cache.get_or_set(
+        COUNT_VERSION_KEY.format(label=label), lambda: uuid4().hex, None)
+
+
+def bump_count_version(label):
+    cache.set(COUNT_VERSION_KEY.format(label=label), uuid4().hex, None)
+
+
+FEED_KEY = 'feed:{user_id}'
+
+
+def get_feed(user_id):
+    """Последние рецепты из подписок пользователя.
+
+    Словарь с ключами entries - список пар (pub_date, id) от новых
+    к старым и complete - содержит ли список всю ленту.
+    """
+    return cache.get(FEED_KEY.format(user_id=user_id))
+
+
+def set_feed(user_id, entries):
+    feed = {'entries': entries,
+            'complete': len(entries) < settings.FEED_CACHE_SIZE}
+    cache.set(
+        FEED_KEY.format(user_id=user_id), feed, settings.FEED_CACHE_TIMEOUT)
+    return feed
+
+
+def invalidate_feed(user_id):
+    cache.delete(FEED_KEY.format(user_id=user_id))
+
+
+def update_feeds(user_ids, update):
+    # Меняет только уже закэшированные ленты подписчиков
+    feeds = cache.get_many(
+        [FEED_KEY.format(user_id=user_id) for user_id in user_ids])
+    for feed in feeds.values():
+        entries = update(feed['entries'])
+        if len(entries) > settings.FEED_CACHE_SIZE:
+            entries = entries[:settings.FEED_CACHE_SIZE]
+            feed['complete'] = False
+        feed['entries'] = entries
+    cache.set_many(feeds, settings.FEED_CACHE_TIMEOUT)
+
+
+def push_to_feeds(user_ids, pub_date, recipe_id):
+    update_feeds(user_ids, lambda entries: sorted(
+        entries + [(pub_date, recipe_id)], reverse=True))
+
+
+def remove_from_feeds(user_ids, recipe_id):
+    update_feeds(user_ids, lambda entries: [
+        entry for entry in entries if entry[1] != recipe_id])
+
+
+RESPONSE_VERSION_KEY = 'recipe_responses_version:{scope}'
+ANONYMOUS_RESPONSE_KEY = 'anonymous_recipes:{digest}'
+ANONYMOUS_STATS_KEY = 'anonymous_recipes_stats:{name}'
+
+
+def get_recipe_list_scopes(author_id=None, tag_slugs=()):
+    """Области, от которых зависит страница списка рецептов.
+
+    Страница автора меняется только вместе с его рецептами, страница
+    с тегами - с рецептами этих тегов, остальные - с любым рецептом.
+    """
+    if author_id is not None:
+        return (f'author:{author_id}',)
+    if tag_slugs:
+        return tuple(f'tag:{slug}' for slug in sorted(set(tag_slugs)))
+    return ('all',)
+
+
+def get_anonymous_response_key(scopes, params):
+    # В ключ входят версии областей и справочников, поэтому после
+    # смены версии старые записи больше не читаются и вытесняются
+    keys = [RESPONSE_VERSION_KEY.format(scope=scope) for scope in scopes]
+    keys.append(CATALOG_VERSION_KEY)
+    versions = cache.get_many(keys)
+    missing = {key: uuid4().hex for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    digest = md5('|'.join(
+        [versions[key] for key in keys] + [params]).encode()).hexdigest()
+    return ANONYMOUS_RESPONSE_KEY.format(digest=digest)
+
+
+def invalidate_recipe_responses(recipe_ids, author_ids=(), tag_slugs=(),
+                                lists=True):
+    scopes = [f'recipe:{recipe_id}' for recipe_id in recipe_ids]
+    if lists:
+        scopes += ['all', *(f'author:{author_id}' for author_id in author_ids),
+                   *(f'tag:{slug}' for slug in tag_slugs)]
+    cache.set_many(
+        {RESPONSE_VERSION_KEY.format(scope=scope): uuid4().hex
+         for scope in scopes},
+        None,
+    )
+
+
+def invalidate_recipes(recipe_ids):
+    # Сбрасывает ответы с рецептами, их авторами и тегами
+    recipe_ids = list(recipe_ids)
+    if not recipe_ids:
+        return
+    invalidate_recipe_responses(
+        recipe_ids,
+        set(Recipe.objects.filter(pk__in=recipe_ids).values_list(
+            'author_id', flat=True)),
+        set(Tag.objects.filter(recipes__in=recipe_ids).values_list(
+            'slug', flat=True)),
+    )
+
+
+def count_anonymous_response(hit):
+    key = ANONYMOUS_STATS_KEY.format(name='hits' if hit else 'misses')
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+
+
+def get_anonymous_response_stats():
+    keys = {name: ANONYMOUS_STATS_KEY.format(name=name)
+            for name in ('hits', 'misses')}
+    stats = cache.get_many(keys.values())
+    return {name: stats.get(key, 0) for name, key in keys.items()}
+
+
+def reset_anonymous_response_stats():
+    cache.delete_many([ANONYMOUS_STATS_KEY.format(name=name)
+                       for name in ('hits', 'misses')])
@@ -0,0 +1,122 @@
+from array import array
+from bisect import bisect_left
+from threading import Lock
+
+from .cache import get_catalog_version
+from .models import Ingredient
+
+# Поиск по подстроке - только для запросов от трех символов, как
+# у триграммного индекса в БД
+SUBSTRING_MIN_LENGTH = 3
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class IngredientCatalog:
+    """Неизменяемый справочник ингредиентов в памяти воркера.
+
+    Названия хранятся отсортированным списком, идентификаторы и единицы
+    измерения — параллельными массивами, без объектов моделей.
+    """
+
+    def __init__(self, rows):
+        rows = sorted(rows, key=lambda row: (row[1].lower(), row[0]))
+        self.units = sorted({unit for _, _, unit in rows})
+        unit_index = {unit: index for index, unit in enumerate(self.units)}
+        self.names = [name for _, name, _ in rows]
+        self.lower_names = [name.lower() for name in self.names]
+        self.ids = array('q', (pk for pk, _, _ in rows))
+        self.unit_ids = array('l', (unit_index[unit] for _, _, unit in rows))
+        # Позиции строк, упорядоченные по id, для поиска по первичному ключу
+        positions = sorted(range(len(rows)), key=self.ids.__getitem__)
+        self.sorted_ids = array('q', (self.ids[i] for i in positions))
+        self.id_positions = array('l', positions)
+        # Триграммы названий: для каждой - возрастающие позиции строк,
+        # в названии которых она встречается
+        postings = {}
+        for position, lower_name in enumerate(self.lower_names):
+            for trigram in trigrams(lower_name):
+                postings.setdefault(trigram, array('l')).append(position)
+        self.postings = postings
+
+    def __len__(self):
+        return len(self.ids)
+
+    def item(self, position):
+        return {
+            'id': self.ids[position],
+            'name': self.names[position],
+            'measurement_unit': self.units[self.unit_ids[position]],
+        }
+
+    def get(self, pk):
+        index = bisect_left(self.sorted_ids, pk)
+        if index < len(self.sorted_ids) and self.sorted_ids[index] == pk:
+            return self.item(self.id_positions[index])
+        return None
+
+    def prefix_positions(self, name, limit=None):
+        position = bisect_left(self.lower_names, name)
+        while ((limit is None or limit > 0)
+               and position < len(self.lower_names)
+               and self.lower_names[position].startswith(name)):
+            yield position
+            position += 1
+            if limit is not None:
+                limit -= 1
+
+    def startswith(self, name):
+        # Все ингредиенты с заданным началом названия, для пустой
+        # строки - весь справочник
+        return [self.item(position)
+                for position in self.prefix_positions(name.lower())]
+
+    def search(self, name, limit):
+        # Сначала совпадения по началу названия, затем по подстроке
+        name = name.lower()
+        found = list(self.prefix_positions(name, limit))
+        if len(found) < limit and len(name) >= SUBSTRING_MIN_LENGTH:
+            for position in self.substring_positions(name):
+                if not self.lower_names[position].startswith(name):
+                    found.append(position)
+                    if len(found) == limit:
+                        break
+        return [self.item(position) for position in found]
+
+    def substring_positions(self, name):
+        # Кандидаты - строки самой редкой триграммы запроса, которые
+        # есть в списках остальных триграмм; подстрока проверяется
+        # только у них
+        lists = sorted(
+            (self.postings.get(trigram, ()) for trigram in trigrams(name)),
+            key=len)
+        for position in lists[0]:
+            if (all(contains(other, position) for other in lists[1:])
+                    and name in self.lower_names[position]):
+                yield position
+
+
+def contains(positions, position):
+    index = bisect_left(positions, position)
+    return index < len(positions) and positions[index] == position
+
+
+_catalog = None
+_catalog_version = None
+_lock = Lock()
+
+
+def get_ingredient_catalog():
+    # Справочник перезагружается, когда меняется версия в кэше
+    global _catalog, _catalog_version
+    version = get_catalog_version()
+    if _catalog is None or _catalog_version != version:
+        with _lock:
+            if _catalog is None or _catalog_version != version:
+                _catalog = IngredientCatalog(
+                    Ingredient.objects.values_list(
+                        'id', 'name', 'measurement_unit').iterator())
+                _catalog_version = version
+    return _catalog
@@ -0,0 +1,81 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import PurePosixPath
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .cache import invalidate_recipes
+from .models import Recipe
+
+logger = logging.getLogger(__name__)
+
+# Размеры уменьшенных копий фото рецепта: название -> (ширина, высота)
+IMAGE_VARIANTS = {
+    'thumbnail': (160, 160),
+    'card': (480, 480),
+    'detail': (1200, 1200),
+}
+VARIANTS_DIR = 'recipes/images/variants/'
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.IMAGE_PROCESSING_WORKERS,
+            thread_name_prefix='recipe-images',
+        )
+    return _executor
+
+
+def make_variants(image_name):
+    # Сохраняет WebP-копии фото и возвращает их пути в хранилище
+    variants = {'original': image_name}
+    stem = PurePosixPath(image_name).stem
+    with default_storage.open(image_name) as file:
+        with Image.open(file) as image:
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            for variant, size in IMAGE_VARIANTS.items():
+                resized = image.copy()
+                resized.thumbnail(size)
+                buffer = BytesIO()
+                resized.save(buffer, 'WEBP', quality=80)
+                variants[variant] = default_storage.save(
+                    f'{VARIANTS_DIR}{stem}_{variant}.webp',
+                    ContentFile(buffer.getvalue()),
+                )
+    return variants
+
+
+def process_recipe_image(recipe_id, image_name):
+    close_old_connections()
+    try:
+        variants = make_variants(image_name)
+        # Фото могло смениться, пока готовились копии
+        if Recipe.objects.filter(pk=recipe_id, image=image_name).update(
+                image_variants=variants, updated_at=timezone.now()):
+            invalidate_recipes((recipe_id,))
+    except Exception:
+        logger.exception('Failed to process image of recipe %s', recipe_id)
+    finally:
+        connection.close()
+
+
+def schedule_image_processing(recipe):
+    recipe_id, image_name = recipe.pk, recipe.image.name
+    if settings.IMAGE_PROCESSING_ASYNC:
+        transaction.on_commit(lambda: get_executor().submit(
+            process_recipe_image, recipe_id, image_name))
+    else:
+        transaction.on_commit(
+            lambda: process_recipe_image(recipe_id, image_name))
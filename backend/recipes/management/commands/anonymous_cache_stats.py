@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from recipes.cache import (get_anonymous_response_stats,
+                           reset_anonymous_response_stats)
+
+
+class Command(BaseCommand):
+    help = 'Показывает долю попаданий в кэш рецептов для анонимов'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset', action='store_true',
+            help='Обнулить счетчики после вывода',
+        )
+
+    def handle(self, *args, **options):
+        stats = get_anonymous_response_stats()
+        total = stats['hits'] + stats['misses']
+        ratio = stats['hits'] / total if total else 0
+        self.stdout.write(
+            f'Попаданий: {stats["hits"]}, промахов: {stats["misses"]}, '
+            f'доля попаданий: {ratio:.1%}'
+        )
+        if options['reset']:
+            reset_anonymous_response_stats()
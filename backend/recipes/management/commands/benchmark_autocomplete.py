@@ -0,0 +1,91 @@
+import random
+import string
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import override_settings
+from rest_framework.test import APIRequestFactory
+
+from api.views import IngredientViewSet
+from recipes.models import Ingredient
+
+
+class Command(BaseCommand):
+    help = ('Замеряет задержку автодополнения ингредиентов на каталоге '
+            'заданного размера. Синтетические ингредиенты добавляются '
+            'в транзакции, которая откатывается после замера')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=100000)
+        parser.add_argument('--queries', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        names = list(Ingredient.objects.values_list('name', flat=True))
+        if not names:
+            raise CommandError(
+                'Справочник пуст, сначала выполните import_catalog')
+        rng = random.Random(options['seed'])
+        count = options['queries']
+        # Начала существующих названий длиной 1-5 символов, подстроки
+        # из середины названий и строки, которых нет в справочнике
+        queries = {
+            'начало': [rng.choice(names)[:rng.randint(1, 5)].lower()
+                       for _ in range(count)],
+            'подстрока': [self.substring(rng.choice(names), rng)
+                          for _ in range(count)],
+            'нет совпадений': [
+                ''.join(rng.choices('qxz', k=rng.randint(3, 5)))
+                for _ in range(count)],
+        }
+        with transaction.atomic():
+            self.grow_catalog(names, options['size'], rng)
+            for mode, in_memory in (('БД', False), ('память', True)):
+                with override_settings(
+                        INGREDIENT_CATALOG_IN_MEMORY=in_memory):
+                    for kind, kind_queries in queries.items():
+                        self.measure(f'{mode}, {kind}', kind_queries)
+            transaction.set_rollback(True)
+
+    @staticmethod
+    def substring(name, rng):
+        name = name.lower()
+        length = min(len(name), rng.randint(3, 5))
+        start = rng.randint(min(1, len(name) - length), len(name) - length)
+        return name[start:start + length]
+
+    def grow_catalog(self, names, size, rng):
+        # Новые названия - существующие с суффиксом, чтобы распределение
+        # начальных букв было как в настоящем справочнике
+        missing = size - Ingredient.objects.count()
+        Ingredient.objects.bulk_create((
+            Ingredient(
+                name=f'{rng.choice(names)} '
+                     f'{"".join(rng.choices(string.ascii_lowercase, k=5))}',
+                measurement_unit='г',
+            ) for _ in range(missing)
+        ), batch_size=5000)
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {Ingredient._meta.db_table}')
+        self.stdout.write(
+            f'Ингредиентов в справочнике: {Ingredient.objects.count()}')
+
+    def measure(self, mode, queries):
+        view = IngredientViewSet.as_view({'get': 'autocomplete'})
+        factory = APIRequestFactory()
+        # Первый запрос загружает каталог в память и не учитывается
+        view(factory.get('/api/ingredients/autocomplete/', {'name': 'а'}))
+        timings = []
+        for name in queries:
+            request = factory.get(
+                '/api/ingredients/autocomplete/', {'name': name})
+            started = time.perf_counter()
+            view(request).render()
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        p50, p99 = (timings[int(len(timings) * share)] * 1000
+                    for share in (0.5, 0.99))
+        self.stdout.write(
+            f'{mode}: {len(timings)} запросов, p50 {p50:.2f} мс, '
+            f'p99 {p99:.2f} мс')
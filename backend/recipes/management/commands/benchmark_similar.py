@@ -0,0 +1,65 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from recipes.similarity import RecipeVectors
+
+UNITS = ('г', 'мл', 'шт', 'ст. л.')
+
+
+class Command(BaseCommand):
+    help = ('Замеряет построение векторов рецептов и поиск похожих '
+            'на синтетических данных без обращения к БД')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', type=int, nargs='+', default=[100000, 1000000],
+            help='Количества рецептов',
+        )
+        parser.add_argument('--ingredients', type=int, default=2000)
+        parser.add_argument('--tags', type=int, default=20)
+        parser.add_argument('--queries', type=int, default=300)
+        parser.add_argument('--limit', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        for size in options['sizes']:
+            vectors = self.build(rng, size, options)
+            timings = []
+            for recipe_id in rng.integers(1, size + 1, options['queries']):
+                started = time.perf_counter()
+                vectors.similar(int(recipe_id), options['limit'])
+                timings.append(time.perf_counter() - started)
+            p50, p99 = np.percentile(timings, (50, 99)) * 1000
+            self.stdout.write(
+                f'{size} рецептов: поиск p50 {p50:.1f} мс, '
+                f'p99 {p99:.1f} мс')
+
+    def build(self, rng, size, options):
+        # Популярность ингредиентов распределена по закону Ципфа:
+        # немного частых (соль, сахар) и длинный хвост редких
+        count = options['ingredients']
+        popularity = 1 / np.arange(1, count + 1) ** 0.9
+        popularity /= popularity.sum()
+        recipe_ids = np.repeat(
+            np.arange(1, size + 1), rng.integers(3, 12, size))
+        ingredients = np.stack((
+            recipe_ids,
+            rng.choice(np.arange(1, count + 1), len(recipe_ids),
+                       p=popularity),
+            rng.integers(1, 500, len(recipe_ids)),
+        ), axis=1)
+        tagged = np.repeat(np.arange(1, size + 1), rng.integers(0, 3, size))
+        tags = np.stack(
+            (tagged, rng.integers(1, options['tags'] + 1, len(tagged))),
+            axis=1)
+        units = {pk: UNITS[pk % len(UNITS)] for pk in range(1, count + 1)}
+        started = time.perf_counter()
+        vectors = RecipeVectors.build(ingredients, tags, units, timezone.now())
+        self.stdout.write(
+            f'{size} рецептов: построение '
+            f'{time.perf_counter() - started:.2f} с')
+        return vectors
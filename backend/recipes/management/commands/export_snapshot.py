@@ -0,0 +1,240 @@
+import shutil
+import time
+from datetime import datetime, timedelta
+from itertools import chain, islice
+from pathlib import Path
+
+import lance
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from recipes.models import (Favorite, Recipe, RecipeIngredients, RecipeTags,
+                            ShoppingCart, Tag)
+
+TIMESTAMP = pa.timestamp('us', tz='UTC')
+
+# Таблица снимка: queryset и колонки с типами Arrow. Таблицы с колонкой
+# pub_date дописываются только новыми рецептами старше
+# ANALYTICS_SNAPSHOT_DELAY, остальные перезаписываются целиком
+TABLES = {
+    'recipes': (
+        Recipe.objects.order_by('pub_date', 'id'),
+        {
+            'id': pa.int64(),
+            'author_id': pa.int64(),
+            'name': pa.string(),
+            'text': pa.string(),
+            'cooking_time': pa.int32(),
+            'pub_date': TIMESTAMP,
+            'favorites_count': pa.int32(),
+            'shopping_cart_count': pa.int32(),
+        },
+    ),
+    'recipe_ingredients': (
+        RecipeIngredients.objects.annotate(
+            ingredient_name=F('ingredient__name'),
+            measurement_unit=F('ingredient__measurement_unit'),
+            pub_date=F('recipe__pub_date'),
+        ).order_by('pub_date', 'id'),
+        {
+            'recipe_id': pa.int64(),
+            'ingredient_id': pa.int64(),
+            'ingredient_name': pa.string(),
+            'measurement_unit': pa.string(),
+            'amount': pa.int32(),
+            'pub_date': TIMESTAMP,
+        },
+    ),
+    'recipe_tags': (
+        RecipeTags.objects.annotate(
+            pub_date=F('recipe__pub_date'),
+        ).order_by('pub_date', 'id'),
+        {
+            'recipe_id': pa.int64(),
+            'tag_id': pa.int64(),
+            'pub_date': TIMESTAMP,
+        },
+    ),
+    'tags': (
+        Tag.objects.order_by('id'),
+        {
+            'id': pa.int64(),
+            'name': pa.string(),
+            'color': pa.string(),
+            'slug': pa.string(),
+        },
+    ),
+    'favorites': (
+        Favorite.objects.order_by('id'),
+        {'id': pa.int64(), 'user_id': pa.int64(), 'recipe_id': pa.int64()},
+    ),
+    'shopping_cart': (
+        ShoppingCart.objects.order_by('id'),
+        {'id': pa.int64(), 'user_id': pa.int64(), 'recipe_id': pa.int64()},
+    ),
+}
+
+
+def read_batches(queryset, schema, batch_size):
+    # Серверный курсор PostgreSQL отдает строки порциями, в памяти
+    # одновременно находится только одна пачка
+    rows = queryset.values_list(*schema.names).iterator(
+        chunk_size=batch_size)
+    while batch := list(islice(rows, batch_size)):
+        yield pa.RecordBatch.from_arrays(
+            [pa.array(column, field.type)
+             for column, field in zip(zip(*batch), schema)],
+            schema=schema,
+        )
+
+
+class LanceStore:
+    def __init__(self, path):
+        self.path = path
+
+    def uri(self, name):
+        return str(self.path / f'{name}.lance')
+
+    def exists(self, name):
+        return Path(self.uri(name)).exists()
+
+    def read_column(self, name, column):
+        if not self.exists(name):
+            return None
+        return lance.dataset(self.uri(name)).to_table(columns=[column])
+
+    def write(self, name, schema, batches, append):
+        # Каждая запись создает новую версию набора данных, прежние
+        # версии доступны через lance.dataset(uri, version=...)
+        exists = self.exists(name)
+        dataset = lance.write_dataset(
+            pa.RecordBatchReader.from_batches(schema, batches),
+            self.uri(name),
+            schema=schema,
+            mode=('append' if append else 'overwrite') if exists
+            else 'create',
+        )
+        return dataset.version
+
+
+class ParquetStore:
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self, name):
+        return any((self.path / name).glob('*.parquet'))
+
+    def read_column(self, name, column):
+        directory = self.path / name
+        if not self.exists(name):
+            return None
+        return ds.dataset(directory, format='parquet').to_table(
+            columns=[column])
+
+    def write(self, name, schema, batches, append):
+        # Версия - метка времени файла: добавление кладет новый файл
+        # рядом, перезапись заменяет каталог целиком
+        version = datetime.now().strftime('%Y%m%d%H%M%S%f')
+        directory = self.path / name
+        target = directory if append else self.path / f'.{name}.new'
+        if not append:
+            shutil.rmtree(target, ignore_errors=True)
+        target.mkdir(parents=True, exist_ok=True)
+        with pq.ParquetWriter(
+                target / f'part-{version}.parquet', schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+        if not append:
+            shutil.rmtree(directory, ignore_errors=True)
+            target.rename(directory)
+        return version
+
+
+STORES = {'lance': LanceStore, 'parquet': ParquetStore}
+
+
+class Command(BaseCommand):
+    help = ('Выгружает рецепты, ингредиенты, теги, избранное и списки '
+            'покупок в колоночный снимок для аналитики')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path', default=settings.ANALYTICS_SNAPSHOT_DIR,
+            help='Каталог снимка',
+        )
+        parser.add_argument(
+            '--format', choices=STORES, default='lance',
+        )
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument(
+            '--full', action='store_true',
+            help='Перезаписать все таблицы, а не дописывать новые рецепты '
+                 '(нужно после изменения или удаления старых рецептов)',
+        )
+
+    def get_watermark(self, store, name):
+        # Последняя выгруженная дата публикации читается из самого
+        # снимка, поэтому прерванная выгрузка таблицы просто повторится
+        table = store.read_column(name, 'pub_date')
+        if table is None or not table.num_rows:
+            return None
+        return pc.max(table.column(0)).as_py()
+
+    def handle(self, *args, **options):
+        path = Path(options['path'])
+        path.mkdir(parents=True, exist_ok=True)
+        store = STORES[options['format']](path)
+        # Все таблицы читаются из одного согласованного снимка БД
+        with transaction.atomic(), connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL '
+                               'REPEATABLE READ READ ONLY')
+            cutoff = timezone.now() - timedelta(
+                seconds=settings.ANALYTICS_SNAPSHOT_DELAY)
+            for name, (queryset, fields) in TABLES.items():
+                self.export_table(
+                    store, name, queryset, pa.schema(fields.items()),
+                    cutoff, options)
+
+    def export_table(self, store, name, queryset, schema, cutoff, options):
+        started = time.monotonic()
+        append = 'pub_date' in schema.names and not options['full']
+        if 'pub_date' in schema.names:
+            # Все рецепты до cutoff уже зафиксированы, поэтому следующая
+            # выгрузка продолжит с последней даты без пропусков
+            queryset = queryset.filter(pub_date__lte=cutoff)
+        if append:
+            watermark = self.get_watermark(store, name)
+            if watermark is not None:
+                queryset = queryset.filter(pub_date__gt=watermark)
+        batches = read_batches(queryset, schema, options['batch_size'])
+        first = next(batches, None)
+        # Пустая таблица при первой выгрузке записывается со схемой,
+        # чтобы у читателей снимка были все наборы данных
+        if first is None and append and store.exists(name):
+            self.stdout.write(f'{name}: новых строк нет')
+            return
+        rows = 0
+
+        def counted(batches):
+            nonlocal rows
+            for batch in batches:
+                rows += batch.num_rows
+                yield batch
+
+        version = store.write(
+            name, schema,
+            counted(batches if first is None else chain((first,), batches)),
+            append,
+        )
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            f'{name}: {"добавлено" if append else "записано"} {rows} строк, '
+            f'версия {version}, {rows / elapsed:.0f} строк/с')
@@ -0,0 +1,208 @@
+import csv
+import json
+import re
+import time
+from io import StringIO
+from itertools import islice
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from rest_framework.exceptions import ValidationError
+
+from recipes.cache import bump_catalog_version
+from recipes.models import Ingredient, Tag
+from recipes.validators import validate_color
+
+DATA_DIR = settings.BASE_DIR / 'recipes' / 'management'
+JSON_CHUNK_SIZE = 64 * 1024
+WHITESPACE = re.compile(r'\s*')
+
+
+def read_json_array(file):
+    # Элементы списка разбираются по одному из буфера, который
+    # дочитывается кусками, поэтому файл целиком в память не попадает
+    decoder = json.JSONDecoder()
+    buffer, position = '', 0
+    started = False
+    while True:
+        position = WHITESPACE.match(buffer, position).end()
+        if position == len(buffer):
+            chunk = file.read(JSON_CHUNK_SIZE)
+            if not chunk:
+                raise CommandError('JSON оборвался до конца списка')
+            buffer, position = chunk, 0
+            continue
+        char = buffer[position]
+        if not started:
+            if char != '[':
+                raise CommandError('JSON должен быть списком объектов')
+            position += 1
+            started = True
+        elif char == ']':
+            return
+        elif char == ',':
+            position += 1
+        else:
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                chunk = file.read(JSON_CHUNK_SIZE)
+                if not chunk:
+                    raise CommandError('Некорректный JSON')
+                buffer, position = buffer[position:] + chunk, 0
+                continue
+            yield item
+
+
+def read_rows(path, fields):
+    # CSV (без заголовка, колонки в порядке fields) и JSON (список
+    # объектов) читаются потоком
+    path = Path(path)
+    if path.suffix not in ('.csv', '.json'):
+        raise CommandError(f'Неизвестный формат файла: {path}')
+    try:
+        file = path.open(encoding='utf-8', newline='')
+    except OSError as error:
+        raise CommandError(f'Не удалось открыть {path}: {error}')
+    with file:
+        if path.suffix == '.csv':
+            yield from csv.reader(file)
+        else:
+            for item in read_json_array(file):
+                yield [item.get(field) for field in fields]
+
+
+def copy_rows(cursor, table, fields, rows, batch_size):
+    # Строки пачками передаются в промежуточную таблицу через COPY
+    copied = 0
+    rows = iter(rows)
+    while batch := list(islice(rows, batch_size)):
+        buffer = StringIO()
+        csv.writer(buffer).writerows(batch)
+        buffer.seek(0)
+        cursor.copy_expert(
+            f'COPY {table} ({", ".join(fields)}) FROM STDIN WITH CSV',
+            buffer,
+        )
+        copied += len(batch)
+    return copied
+
+
+class Command(BaseCommand):
+    help = ('Загружает справочники ингредиентов и тегов. Существующие '
+            'записи не удаляются, повторный запуск ничего не меняет')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ingredients', default=DATA_DIR / 'ingredients.json',
+            help='CSV (название,единица) или JSON с ингредиентами',
+        )
+        parser.add_argument(
+            '--tags', default=DATA_DIR / 'tags.json',
+            help='CSV (название,цвет,слаг) или JSON с тегами',
+        )
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def clean(self, rows, model, fields):
+        # Пустые и слишком длинные значения пропускаются
+        self.skipped = 0
+        lengths = [model._meta.get_field(field).max_length
+                   for field in fields]
+        for row in rows:
+            row = [(value or '').strip() for value in row[:len(fields)]]
+            if len(row) == len(fields) and all(
+                    0 < len(value) <= length
+                    for value, length in zip(row, lengths)):
+                yield row
+            else:
+                self.skipped += 1
+
+    def clean_tags(self, rows):
+        for name, color, slug in self.clean(
+                rows, Tag, ('name', 'color', 'slug')):
+            try:
+                validate_color(color)
+            except ValidationError:
+                self.skipped += 1
+                continue
+            yield name, color, slug
+
+    def import_ingredients(self, cursor, path, batch_size):
+        fields = ('name', 'measurement_unit')
+        cursor.execute(
+            'CREATE TEMP TABLE import_ingredient '
+            '(name text, measurement_unit text) ON COMMIT DROP')
+        read = copy_rows(
+            cursor, 'import_ingredient', fields,
+            self.clean(read_rows(path, fields), Ingredient, fields),
+            batch_size,
+        )
+        # Ингредиент целиком определяется названием и единицей,
+        # поэтому добавляются только отсутствующие пары
+        cursor.execute(f'''
+            INSERT INTO {Ingredient._meta.db_table} (name, measurement_unit)
+            SELECT DISTINCT name, measurement_unit FROM import_ingredient s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {Ingredient._meta.db_table} i
+                WHERE i.name = s.name
+                AND i.measurement_unit = s.measurement_unit
+            )
+        ''')
+        return read, cursor.rowcount, 0
+
+    def import_tags(self, cursor, path, batch_size):
+        fields = ('name', 'color', 'slug')
+        cursor.execute(
+            'CREATE TEMP TABLE import_tag '
+            '(name text, color text, slug text) ON COMMIT DROP')
+        read = copy_rows(
+            cursor, 'import_tag', fields,
+            self.clean_tags(read_rows(path, fields)), batch_size,
+        )
+        # Тег с тем же слагом обновляется, только если что-то изменилось
+        table = Tag._meta.db_table
+        cursor.execute(f'''
+            INSERT INTO {table} (name, color, slug)
+            SELECT DISTINCT ON (slug) name, color, slug FROM import_tag
+            ON CONFLICT (slug) DO UPDATE
+            SET name = EXCLUDED.name, color = EXCLUDED.color
+            WHERE ({table}.name, {table}.color)
+                IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.color)
+            RETURNING xmax = 0
+        ''')
+        inserted = [row[0] for row in cursor.fetchall()]
+        return read, inserted.count(True), inserted.count(False)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError(
+                'Импорт через COPY работает только с PostgreSQL')
+        started = time.monotonic()
+        results = {}
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Параллельный запуск дождется окончания текущего импорта
+            cursor.execute(
+                f'LOCK TABLE {Ingredient._meta.db_table}, '
+                f'{Tag._meta.db_table} IN SHARE ROW EXCLUSIVE MODE')
+            for name, method, path in (
+                ('Ингредиенты', self.import_ingredients,
+                 options['ingredients']),
+                ('Теги', self.import_tags, options['tags']),
+            ):
+                results[name] = (
+                    *method(cursor, path, options['batch_size']),
+                    self.skipped,
+                )
+        elapsed = time.monotonic() - started
+        read = sum(result[0] for result in results.values())
+        if any(result[1] or result[2] for result in results.values()):
+            bump_catalog_version()
+        for name, (rows, inserted, updated, skipped) in results.items():
+            self.stdout.write(
+                f'{name}: прочитано {rows}, добавлено {inserted}, '
+                f'обновлено {updated}, пропущено {skipped}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Загружено {read} строк за {elapsed:.2f} с '
+            f'({read / elapsed:.0f} строк/с)'))
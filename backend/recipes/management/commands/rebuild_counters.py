@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from recipes.models import Favorite, Recipe, ShoppingCart
+from users.models import Subscription, User
+
+
+def count_subquery(queryset, field):
+    # Количество строк queryset для каждой строки внешнего запроса
+    return Coalesce(Subquery(
+        queryset.filter(**{field: OuterRef('pk')}).order_by().values(
+            field).annotate(count=Count('pk')).values('count')
+    ), 0)
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счетчики избранного, покупок и подписчиков'
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        recipes = Recipe.objects.update(
+            favorites_count=count_subquery(Favorite.objects, 'recipe'),
+            shopping_cart_count=count_subquery(
+                ShoppingCart.objects, 'recipe'),
+        )
+        users = User.objects.update(
+            subscribers_count=count_subquery(
+                Subscription.objects, 'author'),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Пересчитано рецептов: {recipes}, пользователей: {users}'))
@@ -0,0 +1,178 @@
+from datetime import timedelta
+from itertools import chain
+from threading import Lock
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from .cache import get_recipe_matrix_version
+from .models import Recipe, RecipeIngredients
+
+# Изменения рецептов перечитываются с запасом: рецепт, сохраненный
+# до построения матрицы, мог стать видимым после него
+CHANGES_OVERLAP = timedelta(minutes=1)
+EMPTY = np.empty(0, dtype=np.int32)
+# Число корзин гистограммы долей для поиска порога лучших рецептов
+LEVELS = 1024
+
+
+class RecipeIngredientMatrix:
+    """Разреженная матрица рецепт x ингредиент в памяти воркера.
+
+    Хранится инвертированным индексом: для каждого ингредиента - номера
+    строк рецептов, в которых он есть. Рецепты, измененные после
+    построения, лежат в небольшом словаре поверх матрицы.
+    """
+
+    def __init__(self, pairs, watermark):
+        # pairs - массив пар (recipe_id, ingredient_id)
+        self.watermark = watermark
+        self.recipe_ids, rows = np.unique(pairs[:, 0], return_inverse=True)
+        self.totals = np.bincount(
+            rows, minlength=len(self.recipe_ids)).astype(np.int32)
+        self.inverse_totals = 1 / self.totals
+        ingredients = pairs[:, 1]
+        order = np.argsort(ingredients, kind='stable')
+        self.postings = rows[order].astype(np.int32)
+        # Строки ингредиента pk - postings[offsets[pk]:offsets[pk + 1]]
+        counts = np.bincount(ingredients)
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.overlay = {}
+        self.stale_rows = EMPTY
+
+    def __len__(self):
+        return len(self.recipe_ids) - len(self.stale_rows) + len(self.overlay)
+
+    def update(self, changes, watermark=None):
+        # Строки измененных рецептов исключаются из матрицы, их новый
+        # состав хранится в overlay. Словарь и массив заменяются
+        # целиком, чтобы не мешать параллельному поиску
+        overlay = dict(self.overlay)
+        stale = set(self.stale_rows.tolist())
+        positions = np.searchsorted(self.recipe_ids, list(changes))
+        for (recipe_id, ingredients), position in zip(
+                changes.items(), positions):
+            if (position < len(self.recipe_ids)
+                    and self.recipe_ids[position] == recipe_id):
+                stale.add(int(position))
+            if ingredients:
+                overlay[recipe_id] = frozenset(ingredients)
+            else:
+                overlay.pop(recipe_id, None)
+        self.overlay = overlay
+        self.stale_rows = np.array(sorted(stale), dtype=np.int32)
+        if watermark is not None:
+            self.watermark = watermark
+
+    def remove(self, recipe_ids):
+        self.update({recipe_id: () for recipe_id in recipe_ids})
+
+    def match(self, ingredient_ids, limit):
+        """Рецепты с наибольшей долей имеющихся ингредиентов.
+
+        Возвращает список (recipe_id, совпало, всего) по убыванию доли,
+        при равной доле - по числу совпавших ингредиентов.
+        """
+        ingredient_ids = np.unique(np.asarray(ingredient_ids, np.int64))
+        rows = np.concatenate([EMPTY] + [
+            self.postings[self.offsets[pk]:self.offsets[pk + 1]]
+            for pk in ingredient_ids if 0 <= pk < len(self.offsets) - 1
+        ])
+        if len(rows) * 8 < len(self.recipe_ids):
+            # Редкие ингредиенты: считаются только встретившиеся строки
+            candidates, matched = np.unique(rows, return_counts=True)
+            matched[np.isin(candidates, self.stale_rows)] = 0
+        else:
+            candidates = slice(None)
+            matched = np.bincount(rows, minlength=len(self.recipe_ids))
+            matched[self.stale_rows] = 0
+        coverage = matched * self.inverse_totals[candidates]
+        # Вместо сортировки всех рецептов находится порог, выше которого
+        # лежит не меньше limit рецептов: обычно хватает максимальной
+        # доли, иначе порог ищется по гистограмме долей
+        best = coverage.max(initial=0)
+        top = np.flatnonzero(coverage >= best) if best else EMPTY
+        if len(top) < limit:
+            levels = (coverage * LEVELS).astype(np.int16)
+            above = np.cumsum(
+                np.bincount(levels, minlength=LEVELS + 1)[::-1])
+            level = max(LEVELS - int(np.searchsorted(above, limit)), 1)
+            top = np.flatnonzero(levels >= level)
+        recipe_ids = self.recipe_ids[candidates][top]
+        matched = matched[top]
+        totals = self.totals[candidates][top]
+        coverage = coverage[top]
+        if self.overlay:
+            have = set(ingredient_ids.tolist())
+            extra = [(recipe_id, len(have & ingredients), len(ingredients))
+                     for recipe_id, ingredients in self.overlay.items()]
+            extra = np.array([row for row in extra if row[1]],
+                             dtype=np.int64).reshape(-1, 3)
+            recipe_ids = np.concatenate((recipe_ids, extra[:, 0]))
+            matched = np.concatenate((matched, extra[:, 1]))
+            totals = np.concatenate((totals, extra[:, 2]))
+            coverage = np.concatenate((coverage, extra[:, 1] / extra[:, 2]))
+        if len(coverage) > limit:
+            # При равной доле выше рецепт с большим числом совпадений
+            top = np.argpartition(-(coverage + matched * 1e-6), limit - 1)
+            top = top[:limit]
+        else:
+            top = np.arange(len(coverage))
+        top = top[np.lexsort((-matched[top], -coverage[top]))]
+        return [
+            (int(recipe_ids[i]), int(matched[i]), int(totals[i]))
+            for i in top
+        ]
+
+
+def read_pairs(queryset):
+    # Пары читаются серверным курсором сразу в плоский массив
+    return np.fromiter(
+        chain.from_iterable(queryset.values_list(
+            'recipe_id', 'ingredient_id').iterator(chunk_size=10000)),
+        dtype=np.int64,
+    ).reshape(-1, 2)
+
+
+def build_recipe_matrix():
+    watermark = timezone.now()
+    return RecipeIngredientMatrix(
+        read_pairs(RecipeIngredients.objects.all()), watermark)
+
+
+def refresh_recipe_matrix(matrix):
+    # Дочитываются только рецепты, сохраненные после прошлого обновления
+    watermark = timezone.now()
+    recipe_ids = list(Recipe.objects.filter(
+        updated_at__gte=matrix.watermark - CHANGES_OVERLAP,
+    ).values_list('id', flat=True))
+    changes = {recipe_id: [] for recipe_id in recipe_ids}
+    for recipe_id, ingredient_id in read_pairs(
+            RecipeIngredients.objects.filter(recipe_id__in=recipe_ids)):
+        changes[int(recipe_id)].append(int(ingredient_id))
+    matrix.update(changes, watermark)
+
+
+_matrix = None
+_matrix_version = None
+_lock = Lock()
+
+
+def get_recipe_matrix():
+    # Матрица строится один раз и дополняется при смене версии в кэше,
+    # которую меняют сигналы сохранения и удаления рецептов
+    global _matrix, _matrix_version
+    version = get_recipe_matrix_version()
+    if _matrix is None or _matrix_version != version:
+        with _lock:
+            if _matrix is None or (
+                    len(_matrix.overlay) + len(_matrix.stale_rows)
+                    > settings.RECIPE_MATRIX_MAX_CHANGES):
+                _matrix = build_recipe_matrix()
+                _matrix_version = version
+            elif _matrix_version != version:
+                refresh_recipe_matrix(_matrix)
+                _matrix_version = version
+    return _matrix
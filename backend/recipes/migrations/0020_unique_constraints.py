@@ -0,0 +1,51 @@
+# Generated by Django 3.2.16 on 2026-10-18 07:50
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+# Модели и поля, по которым удаляются дубликаты перед созданием ограничений
+UNIQUE_FIELDS = (
+    ('Favorite', ('user', 'recipe')),
+    ('ShoppingCart', ('user', 'recipe')),
+    ('RecipeIngredients', ('recipe', 'ingredient')),
+    ('RecipeTags', ('recipe', 'tag')),
+)
+
+
+def remove_duplicates(apps, schema_editor):
+    # Оставляем самую раннюю запись из каждой группы дубликатов
+    for model_name, fields in UNIQUE_FIELDS:
+        model = apps.get_model('recipes', model_name)
+        duplicates = model.objects.values(*fields).order_by().annotate(
+            min_id=Min('id'), count=Count('id')).filter(count__gt=1)
+        for duplicate in duplicates:
+            model.objects.filter(
+                **{field: duplicate[field] for field in fields}
+            ).exclude(id=duplicate['min_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0019_recipetags_tag_recipe_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='favorite',
+            constraint=models.UniqueConstraint(fields=('user', 'recipe'), name='unique_favorite'),
+        ),
+        migrations.AddConstraint(
+            model_name='recipeingredients',
+            constraint=models.UniqueConstraint(fields=('recipe', 'ingredient'), name='unique_recipe_ingredient'),
+        ),
+        migrations.AddConstraint(
+            model_name='recipetags',
+            constraint=models.UniqueConstraint(fields=('recipe', 'tag'), name='unique_recipe_tag'),
+        ),
+        migrations.AddConstraint(
+            model_name='shoppingcart',
+            constraint=models.UniqueConstraint(fields=('user', 'recipe'), name='unique_shopping_cart'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.16 on 2026-10-18 09:05
+
+from django.db import migrations
+
+TRGM_INDEX = 'ingredient_name_trgm_idx'
+
+
+def create_trgm_index(apps, schema_editor):
+    # Индекс для поиска по подстроке в автодополнении ингредиентов.
+    # Создается, только если в сборке PostgreSQL есть pg_trgm (в образе
+    # postgres он есть), без него поиск по подстроке читает таблицу
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        if cursor.fetchone() is None:
+            return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        f'CREATE INDEX IF NOT EXISTS {TRGM_INDEX} ON recipes_ingredient '
+        'USING gin ((LOWER(name) COLLATE "C") gin_trgm_ops)')
+
+
+def drop_trgm_index(apps, schema_editor):
+    schema_editor.execute(f'DROP INDEX IF EXISTS {TRGM_INDEX}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0024_recipe_search_vector'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trgm_index, drop_trgm_index),
+    ]
@@ -1,7 +1,10 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models.functions import Collate, Lower
 
-from users.models import User
+from users.models import CountersMixin, User
 
 from .validators import validate_color
 
@@ -24,6 +27,13 @@ class Ingredient(models.Model):
         verbose_name = 'Ингредиент'
         verbose_name_plural = 'Ингредиенты'
         ordering = ('name',)
+        indexes = (
+            # Индекс для поиска по началу названия без учета регистра
+            models.Index(
+                Collate(Lower('name'), 'C'),
+                name='ingredient_name_prefix_idx',
+            ),
+        )
 
     def __str__(self):
         return self.name
@@ -57,7 +67,9 @@ class Tag(models.Model):
         return self.name
 
 
-class Recipe(models.Model):
+class Recipe(CountersMixin, models.Model):
+    counter_fields = ('favorites_count', 'shopping_cart_count')
+
     author = models.ForeignKey(
         User,
         related_name='recipes',
@@ -75,6 +87,13 @@ class Recipe(models.Model):
         # атрибут обеспечивает способ указания каталога загрузки и имени файла
         upload_to='recipes/images/',
     )
+    # Заполняется фоновой обработкой фото, см. recipes.images
+    image_variants = models.JSONField(
+        verbose_name='Уменьшенные копии фото',
+        default=dict,
+        blank=True,
+        editable=False,
+    )
     text = models.TextField(
         verbose_name='Описание рецепта',
         help_text='Описание рецепта',
@@ -105,11 +124,59 @@ class Recipe(models.Model):
         verbose_name='Дата публикации',
         auto_now_add=True,
     )
+    updated_at = models.DateTimeField(
+        verbose_name='Дата изменения',
+        auto_now=True,
+    )
+    favorites_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='В избранном',
+    )
+    shopping_cart_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='В списках покупок',
+    )
+    # Название, ингредиенты и описание для полнотекстового поиска,
+    # пересчитывается сигналами, см. recipes.search
+    search_vector = SearchVectorField(
+        null=True,
+        editable=False,
+        verbose_name='Поисковый вектор',
+    )
 
     class Meta:
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
         ordering = ('-pub_date',)
+        indexes = (
+            # Ключ курсорной пагинации ленты рецептов
+            models.Index(
+                fields=('-pub_date', '-id'),
+                name='recipe_pub_date_id_idx',
+            ),
+            # Сортировка ленты по популярности
+            models.Index(
+                fields=('-favorites_count', '-id'),
+                name='recipe_favorites_count_idx',
+            ),
+            # Последние рецепты автора для списка подписок
+            models.Index(
+                fields=('author', '-pub_date'),
+                name='recipe_author_pub_date_idx',
+            ),
+            # Дочитывание измененных рецептов в матрицу ингредиентов
+            models.Index(
+                fields=('updated_at',),
+                name='recipe_updated_at_idx',
+            ),
+            # Полнотекстовый поиск рецептов
+            GinIndex(
+                fields=('search_vector',),
+                name='recipe_search_vector_idx',
+            ),
+        )
 
     def __str__(self):
         return self.name
@@ -130,6 +197,19 @@ class RecipeTags(models.Model):
         verbose_name = 'Теги'
         verbose_name_plural = 'Теги'
         ordering = ('tag',)
+        constraints = (
+            models.UniqueConstraint(
+                fields=('recipe', 'tag'),
+                name='unique_recipe_tag',
+            ),
+        )
+        indexes = (
+            # Поиск рецептов по тегу в фильтре RecipeTagFilter
+            models.Index(
+                fields=('tag', 'recipe'),
+                name='recipetags_tag_recipe_idx',
+            ),
+        )
 
     def __str__(self):
         return f"У рецепта {self.recipe} есть тег {self.tag}"
@@ -155,6 +235,12 @@ class RecipeIngredients(models.Model):
         verbose_name = 'Ингредиенты'
         verbose_name_plural = 'Ингредиенты'
         ordering = ('recipe',)
+        constraints = (
+            models.UniqueConstraint(
+                fields=('recipe', 'ingredient'),
+                name='unique_recipe_ingredient',
+            ),
+        )
 
     def __str__(self):
         return f"В рецепте {self.recipe} есть ингредиент {self.ingredient}"
@@ -178,6 +264,12 @@ class Favorite(models.Model):
         verbose_name = 'Избранное'
         verbose_name_plural = 'Избранное'
         ordering = ('recipe',)
+        constraints = (
+            models.UniqueConstraint(
+                fields=('user', 'recipe'),
+                name='unique_favorite',
+            ),
+        )
 
     def __str__(self):
         return f'Избранное пользователя {self.user}'
@@ -201,6 +293,12 @@ class ShoppingCart(models.Model):
         verbose_name = 'Список покупок'
         verbose_name_plural = 'Список покупок'
         ordering = ('recipe',)
+        constraints = (
+            models.UniqueConstraint(
+                fields=('user', 'recipe'),
+                name='unique_shopping_cart',
+            ),
+        )
 
     def __str__(self):
         return (
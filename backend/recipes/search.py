@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector)
+from django.db.models import F, FloatField, OuterRef, Subquery
+from django.db.models.functions import Cast
+
+from .models import Recipe, RecipeIngredients
+
+
+def get_search_vector():
+    # Совпадение в названии весит больше, чем в ингредиентах,
+    # а в ингредиентах - больше, чем в описании
+    ingredient_names = RecipeIngredients.objects.filter(
+        recipe=OuterRef('pk'),
+    ).values('recipe').annotate(
+        names=StringAgg('ingredient__name', ' '),
+    ).values('names')
+    config = settings.RECIPE_SEARCH_CONFIG
+    return (
+        SearchVector('name', weight='A', config=config)
+        + SearchVector(Subquery(ingredient_names), weight='B', config=config)
+        + SearchVector('text', weight='C', config=config)
+    )
+
+
+def update_search_vectors(recipe_ids):
+    # Вектор пересчитывается одним UPDATE на стороне БД, без сигналов
+    # и без изменения updated_at
+    Recipe.objects.filter(pk__in=recipe_ids).update(
+        search_vector=get_search_vector())
+
+
+def search_recipes(queryset, text):
+    """Рецепты, подходящие под запрос, с оценкой релевантности search_rank.
+
+    Запрос разбирается как в поисковиках: слова в кавычках, OR и минус
+    перед исключаемым словом.
+    """
+    query = SearchQuery(text, config=settings.RECIPE_SEARCH_CONFIG,
+                        search_type='websearch')
+    # ts_rank возвращает real, приведение к double precision нужно, чтобы
+    # оценка без потерь проходила через курсор пагинации
+    return queryset.filter(search_vector=query).annotate(
+        search_rank=Cast(SearchRank(F('search_vector'), query), FloatField()))
@@ -0,0 +1,176 @@
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from users.models import Subscription, User
+
+from .cache import (bump_cart_versions, bump_catalog_version,
+                    bump_count_version, bump_recipe_matrix_version,
+                    invalidate_feed, invalidate_recipe_responses,
+                    invalidate_recipes, push_to_feeds, remove_from_feeds)
+from .images import schedule_image_processing
+from .models import (Favorite, Ingredient, Recipe, RecipeIngredients,
+                     RecipeTags, ShoppingCart, Tag)
+from .search import update_search_vectors
+
+# Поля пользователя, которые выводятся в рецептах как автор
+AUTHOR_FIELDS = {'email', 'username', 'first_name', 'last_name'}
+
+# Связь -> модель со счетчиком, поле ссылки на нее и поле счетчика
+COUNTERS = {
+    Favorite: (Recipe, 'recipe_id', 'favorites_count'),
+    ShoppingCart: (Recipe, 'recipe_id', 'shopping_cart_count'),
+    Subscription: (User, 'author_id', 'subscribers_count'),
+}
+
+
+def change_counter(sender, instance, delta):
+    model, field, counter = COUNTERS[sender]
+    model.objects.filter(pk=getattr(instance, field)).update(
+        **{counter: Greatest(F(counter) + delta, 0)})
+
+
+# Счетчики меняются в транзакции, где создается или удаляется связь:
+# в API, в админке и при каскадном удалении
+def counted_relation_saved(sender, instance, created, **kwargs):
+    if created:
+        change_counter(sender, instance, 1)
+
+
+def counted_relation_deleted(sender, instance, **kwargs):
+    change_counter(sender, instance, -1)
+
+
+for counted_relation in COUNTERS:
+    post_save.connect(counted_relation_saved, sender=counted_relation)
+    post_delete.connect(counted_relation_deleted, sender=counted_relation)
+
+
+@receiver((post_save, post_delete), sender=ShoppingCart)
+def shopping_cart_changed(sender, instance, **kwargs):
+    # Версия меняется после коммита, иначе параллельная выгрузка может
+    # сохранить старый список под новой версией
+    transaction.on_commit(lambda: bump_cart_versions((instance.user_id,)))
+
+
+def bump_recipe_carts(recipe_id):
+    # Рецепт изменен: сбрасываем списки покупок, в которых он лежит
+    transaction.on_commit(lambda: bump_cart_versions(
+        ShoppingCart.objects.filter(
+            recipe_id=recipe_id).values_list('user_id', flat=True)))
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_changed(sender, instance, created, **kwargs):
+    # Ингредиенты записываются после рецепта, поэтому поисковый вектор
+    # пересчитывается при коммите, до сброса анонимного кэша
+    transaction.on_commit(lambda: update_search_vectors((instance.pk,)))
+    # Теги нового рецепта записываются после его сохранения, поэтому
+    # анонимный кэш сбрасывается по тегам на момент коммита
+    transaction.on_commit(lambda: invalidate_recipes((instance.pk,)))
+    # Воркеры дочитают изменившийся состав в матрицу ингредиентов
+    transaction.on_commit(bump_recipe_matrix_version)
+    if not created:
+        bump_recipe_carts(instance.pk)
+    else:
+        # Новый рецепт попадает в ленты подписчиков автора
+        transaction.on_commit(lambda: push_to_feeds(
+            get_subscribers(instance.author_id),
+            instance.pub_date, instance.pk))
+    # Уменьшенные копии готовятся в фоне для каждого нового фото
+    image_name = instance.image.name
+    if image_name and instance.image_variants.get('original') != image_name:
+        schedule_image_processing(instance)
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted(sender, instance, **kwargs):
+    transaction.on_commit(lambda: remove_from_feeds(
+        get_subscribers(instance.author_id), instance.pk))
+    # Теги удаленного рецепта сбрасываются сигналом RecipeTags
+    transaction.on_commit(lambda: invalidate_recipe_responses(
+        (instance.pk,), (instance.author_id,)))
+
+
+@receiver((post_save, post_delete), sender=RecipeTags)
+def recipe_tags_changed(sender, instance, **kwargs):
+    transaction.on_commit(lambda: invalidate_recipe_responses(
+        (instance.recipe_id,),
+        tag_slugs=Tag.objects.filter(pk=instance.tag_id).values_list(
+            'slug', flat=True),
+    ))
+
+
+@receiver((post_save, post_delete), sender=Favorite)
+def favorite_changed(sender, instance, **kwargs):
+    # Счетчик избранного в списках обновится по истечении
+    # ANONYMOUS_RECIPES_CACHE_TIMEOUT, сбрасывать все страницы
+    # на каждое добавление в избранное слишком дорого
+    transaction.on_commit(lambda: invalidate_recipe_responses(
+        (instance.recipe_id,), lists=False))
+
+
+@receiver(post_save, sender=User)
+def author_changed(sender, instance, created, update_fields, **kwargs):
+    if created or (update_fields is not None
+                   and not AUTHOR_FIELDS & set(update_fields)):
+        return
+    transaction.on_commit(lambda: invalidate_recipes(
+        Recipe.objects.filter(author=instance).values_list('pk', flat=True)))
+
+
+def get_subscribers(author_id):
+    return Subscription.objects.filter(
+        author_id=author_id).values_list('user_id', flat=True)
+
+
+@receiver((post_save, post_delete), sender=Subscription)
+def subscription_changed(sender, instance, **kwargs):
+    # Иначе параллельный запрос ленты успеет закэшировать ее по
+    # подпискам до коммита
+    transaction.on_commit(lambda: invalidate_feed(instance.user_id))
+
+
+@receiver((post_save, post_delete), sender=Ingredient)
+@receiver((post_save, post_delete), sender=Tag)
+def catalog_changed(sender, **kwargs):
+    # Другой воркер не должен перезагрузить справочник до коммита
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver((post_save, pre_delete), sender=Ingredient)
+def ingredient_changed(sender, instance, created=False, **kwargs):
+    # Название ингредиента входит в поисковые векторы рецептов с ним.
+    # При удалении рецепты выбираются до каскадного удаления связей
+    if created:
+        return
+    recipe_ids = list(RecipeIngredients.objects.filter(
+        ingredient=instance).values_list('recipe_id', flat=True))
+    if recipe_ids:
+        transaction.on_commit(lambda: (
+            update_search_vectors(recipe_ids),
+            invalidate_recipes(recipe_ids),
+        ))
+
+
+# Модели, от изменения которых зависят счетчики в пагинации:
+# отправитель сигнала -> модель, чей счетчик сбрасывается
+COUNTED_MODELS = {
+    Recipe: Recipe,
+    Favorite: Recipe,
+    ShoppingCart: Recipe,
+    Subscription: Subscription,
+    User: User,
+}
+
+
+def counted_model_changed(sender, **kwargs):
+    label = COUNTED_MODELS[sender]._meta.label_lower
+    transaction.on_commit(lambda: bump_count_version(label))
+
+
+for counted_sender in COUNTED_MODELS:
+    post_save.connect(counted_model_changed, sender=counted_sender)
+    post_delete.connect(counted_model_changed, sender=counted_sender)
@@ -0,0 +1,334 @@
+from itertools import chain
+from threading import Lock
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from .cache import get_recipe_matrix_version
+from .matching import CHANGES_OVERLAP, EMPTY
+from .models import Ingredient, Recipe, RecipeIngredients, RecipeTags
+
+# Вес тега до умножения на IDF
+TAG_WEIGHT = 1.0
+# Признаки, которые есть у большей доли рецептов (соль, сахар), но не
+# меньше чем у COMMON_MIN рецептов, не порождают кандидатов, а только
+# уточняют их близость
+COMMON_SHARE = 0.05
+COMMON_MIN = 10000
+
+
+def ingredient_features(ingredient_ids):
+    # Ингредиенты и теги лежат в одном пространстве признаков:
+    # четные номера - ингредиенты, нечетные - теги
+    return np.asarray(ingredient_ids, dtype=np.int64) * 2
+
+
+def tag_features(tag_ids):
+    return np.asarray(tag_ids, dtype=np.int64) * 2 + 1
+
+
+def normalize(rows, weights, size):
+    norms = np.sqrt(np.bincount(rows, weights=weights ** 2, minlength=size))
+    return weights / norms[rows]
+
+
+class RecipeVectors:
+    """Разреженные векторы рецептов по ингредиентам и тегам.
+
+    Вес ингредиента - log(1 + количество / медиана количества для его
+    единицы измерения), вес тега - TAG_WEIGHT, оба умножены на IDF.
+    Векторы нормированы, поэтому скалярное произведение равно косинусной
+    близости. Для поиска хранится инвертированный индекс признак ->
+    строки рецептов, измененные рецепты лежат в overlay поверх него.
+    """
+
+    def __init__(self, recipe_ids, rows, features, weights, unit_scales,
+                 idf, watermark):
+        # rows, features, weights - записи уже нормированных векторов
+        self.recipe_ids = recipe_ids
+        self.unit_scales = unit_scales
+        self.default_scale = (
+            float(np.median(list(unit_scales.values())))
+            if unit_scales else 1.0)
+        self.idf = idf
+        self.watermark = watermark
+        order = np.lexsort((features, rows))
+        rows, features = rows[order], features[order]
+        self.features, self.weights = features, weights[order]
+        self.indptr = np.searchsorted(rows, np.arange(len(recipe_ids) + 1))
+        order = np.argsort(features, kind='stable')
+        self.postings = rows[order].astype(np.int32)
+        self.posting_weights = self.weights[order]
+        counts = np.bincount(features, minlength=len(idf))
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.common = counts > max(COMMON_SHARE * len(recipe_ids),
+                                   COMMON_MIN)
+        self.set_overlay({}, EMPTY)
+
+    @classmethod
+    def build(cls, ingredients, tags, units, watermark):
+        """Векторы всех рецептов.
+
+        ingredients - массив (recipe_id, ingredient_id, amount),
+        tags - массив (recipe_id, tag_id), units - единицы измерения
+        ингредиентов по id.
+        """
+        unit_names = sorted(set(units.values()))
+        codes = {unit: code for code, unit in enumerate(unit_names)}
+        unit_of = np.full(
+            max(units, default=0) + 1, len(unit_names), dtype=np.int32)
+        unit_of[list(units)] = [codes[unit] for unit in units.values()]
+        row_units = unit_of[ingredients[:, 1]]
+        amounts = ingredients[:, 2].astype(np.float64)
+        # Масштаб единицы измерения - медиана количеств в ней
+        order = np.argsort(row_units, kind='stable')
+        groups = np.split(amounts[order], np.cumsum(
+            np.bincount(row_units, minlength=len(unit_names) + 1))[:-1])
+        unit_scales = {
+            unit: max(float(np.median(group)), 1.0)
+            for unit, group in zip(unit_names, groups) if len(group)
+        }
+        scales = np.array(
+            [unit_scales.get(unit, 1.0) for unit in unit_names] + [1.0])
+        recipe_ids = np.unique(np.concatenate(
+            (ingredients[:, 0], tags[:, 0])))
+        rows = np.searchsorted(
+            recipe_ids, np.concatenate((ingredients[:, 0], tags[:, 0])))
+        features = np.concatenate((
+            ingredient_features(ingredients[:, 1]),
+            tag_features(tags[:, 1]),
+        ))
+        weights = np.concatenate((
+            np.log1p(amounts / scales[row_units]),
+            np.full(len(tags), TAG_WEIGHT),
+        ))
+        frequency = np.bincount(features)
+        idf = np.log((1 + len(recipe_ids)) / (1 + frequency)) + 1
+        weights = normalize(rows, weights * idf[features], len(recipe_ids))
+        return cls(recipe_ids, rows, features, weights, unit_scales, idf,
+                   watermark)
+
+    def embed(self, ingredients, tag_ids):
+        # Вектор одного рецепта по масштабам единиц и IDF из построения.
+        # ingredients - список (ingredient_id, unit, amount)
+        features = np.concatenate((
+            ingredient_features([pk for pk, _, _ in ingredients]),
+            tag_features(tag_ids),
+        ))
+        weights = np.array(
+            [np.log1p(amount / self.unit_scales.get(
+                unit, self.default_scale))
+             for _, unit, amount in ingredients]
+            + [TAG_WEIGHT] * len(tag_ids))
+        # Признак, которого не было при построении (в том числе когда
+        # векторы построены по пустой базе), считается редким
+        known = features < len(self.idf)
+        idf = np.full(len(features), self.idf.max(initial=1.0))
+        idf[known] = self.idf[features[known]]
+        weights = weights * idf
+        return features, weights / np.sqrt((weights ** 2).sum())
+
+    def set_overlay(self, overlay, stale_rows):
+        # Словарь и плоские массивы overlay заменяются целиком, чтобы не
+        # мешать параллельному поиску
+        self.overlay = overlay
+        self.stale_rows = stale_rows
+        self.overlay_ids = np.array(list(overlay), dtype=np.int64)
+        vectors = list(overlay.values())
+        self.overlay_rows = np.repeat(
+            np.arange(len(vectors)),
+            [len(features) for features, _ in vectors]).astype(np.int64)
+        self.overlay_features = np.concatenate(
+            [EMPTY] + [features for features, _ in vectors])
+        self.overlay_weights = np.concatenate(
+            [np.empty(0)] + [weights for _, weights in vectors])
+
+    def update(self, changes, watermark=None):
+        # changes - recipe_id -> вектор или None для удаленного рецепта
+        overlay = dict(self.overlay)
+        stale = set(self.stale_rows.tolist())
+        positions = np.searchsorted(self.recipe_ids, list(changes))
+        for (recipe_id, vector), position in zip(changes.items(), positions):
+            if (position < len(self.recipe_ids)
+                    and self.recipe_ids[position] == recipe_id):
+                stale.add(int(position))
+            if vector is not None and len(vector[0]):
+                overlay[recipe_id] = vector
+            else:
+                overlay.pop(recipe_id, None)
+        self.set_overlay(overlay, np.array(sorted(stale), dtype=np.int32))
+        if watermark is not None:
+            self.watermark = watermark
+
+    def remove(self, recipe_ids):
+        self.update({recipe_id: None for recipe_id in recipe_ids})
+
+    def compacted(self):
+        # Перестройка без обращения к БД: из основной части убираются
+        # устаревшие строки и добавляются векторы из overlay
+        rows = np.repeat(np.arange(len(self.recipe_ids)),
+                         np.diff(self.indptr))
+        keep = ~np.isin(rows, self.stale_rows)
+        entry_ids = np.concatenate((
+            self.recipe_ids[rows[keep]], self.overlay_ids[self.overlay_rows]))
+        recipe_ids = np.unique(entry_ids)
+        return RecipeVectors(
+            recipe_ids,
+            np.searchsorted(recipe_ids, entry_ids),
+            np.concatenate((self.features[keep], self.overlay_features)),
+            np.concatenate((self.weights[keep], self.overlay_weights)),
+            self.unit_scales, self.idf, self.watermark,
+        )
+
+    def vector(self, recipe_id):
+        if recipe_id in self.overlay:
+            return self.overlay[recipe_id]
+        position = np.searchsorted(self.recipe_ids, recipe_id)
+        if (position == len(self.recipe_ids)
+                or self.recipe_ids[position] != recipe_id
+                or position in self.stale_rows):
+            return None
+        start, end = self.indptr[position], self.indptr[position + 1]
+        return self.features[start:end], self.weights[start:end]
+
+    def score(self, features, weights, selective):
+        # Кандидаты - рецепты хотя бы с одним признаком из selective
+        known = features < len(self.offsets) - 1
+        rows = np.concatenate([EMPTY] + [
+            self.postings[self.offsets[feature]:self.offsets[feature + 1]]
+            for feature in features[selective]
+        ])
+        contributions = np.concatenate([np.empty(0)] + [
+            self.posting_weights[
+                self.offsets[feature]:self.offsets[feature + 1]] * weight
+            for feature, weight in zip(
+                features[selective], weights[selective])
+        ])
+        if len(rows) * 8 < len(self.recipe_ids):
+            candidates, inverse = np.unique(rows, return_inverse=True)
+            scores = np.bincount(inverse, weights=contributions)
+        else:
+            scores = np.bincount(rows, weights=contributions,
+                                 minlength=len(self.recipe_ids))
+            candidates = np.flatnonzero(scores)
+            scores = scores[candidates]
+        scores = scores.astype(np.float64, copy=False)
+        # Остальные признаки досчитываются только для кандидатов: строки
+        # в списке признака отсортированы, поиск идет бинарный
+        for feature, weight in zip(features[known & ~selective],
+                                   weights[known & ~selective]):
+            start, end = self.offsets[feature], self.offsets[feature + 1]
+            if start == end:
+                continue
+            postings = self.postings[start:end]
+            found = np.minimum(
+                np.searchsorted(postings, candidates), len(postings) - 1)
+            hit = postings[found] == candidates
+            scores[hit] += weight * self.posting_weights[start + found[hit]]
+        return candidates, scores
+
+    def similar(self, recipe_id, limit):
+        """Самые близкие рецепты: список (recipe_id, близость).
+
+        None, если вектора рецепта нет.
+        """
+        vector = self.vector(recipe_id)
+        if vector is None:
+            return None
+        features, weights = vector
+        known = features < len(self.offsets) - 1
+        selective = known.copy()
+        selective[known] = ~self.common[features[known]]
+        candidates, scores = self.score(features, weights, selective)
+        if len(candidates) <= limit and not selective[known].all():
+            # Редких признаков мало - кандидаты ищутся по всем
+            candidates, scores = self.score(features, weights, known)
+        recipe_ids = self.recipe_ids[candidates]
+        scores[np.isin(candidates, self.stale_rows)] = 0
+        if len(self.overlay_ids):
+            mask = np.isin(self.overlay_features, features)
+            order = np.argsort(features)
+            found = order[np.searchsorted(
+                features, self.overlay_features[mask], sorter=order)]
+            recipe_ids = np.concatenate((recipe_ids, self.overlay_ids))
+            scores = np.concatenate((scores, np.bincount(
+                self.overlay_rows[mask],
+                weights=self.overlay_weights[mask] * weights[found],
+                minlength=len(self.overlay_ids),
+            )))
+        scores[recipe_ids == recipe_id] = 0
+        if len(scores) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(int(recipe_ids[i]), float(scores[i]))
+                for i in top if scores[i] > 0]
+
+
+def read_array(queryset, fields):
+    return np.fromiter(
+        chain.from_iterable(
+            queryset.values_list(*fields).iterator(chunk_size=10000)),
+        dtype=np.int64,
+    ).reshape(-1, len(fields))
+
+
+def build_recipe_vectors():
+    watermark = timezone.now()
+    return RecipeVectors.build(
+        read_array(RecipeIngredients.objects.all(),
+                   ('recipe_id', 'ingredient_id', 'amount')),
+        read_array(RecipeTags.objects.all(), ('recipe_id', 'tag_id')),
+        dict(Ingredient.objects.values_list('id', 'measurement_unit')),
+        watermark,
+    )
+
+
+def refresh_recipe_vectors(vectors):
+    # Заново считаются только векторы рецептов, сохраненных после
+    # прошлого обновления
+    watermark = timezone.now()
+    recipe_ids = list(Recipe.objects.filter(
+        updated_at__gte=vectors.watermark - CHANGES_OVERLAP,
+    ).values_list('id', flat=True))
+    ingredients = {recipe_id: [] for recipe_id in recipe_ids}
+    for recipe_id, *row in RecipeIngredients.objects.filter(
+            recipe_id__in=recipe_ids).values_list(
+            'recipe_id', 'ingredient_id', 'ingredient__measurement_unit',
+            'amount'):
+        ingredients[recipe_id].append(row)
+    tags = {recipe_id: [] for recipe_id in recipe_ids}
+    for recipe_id, tag_id in RecipeTags.objects.filter(
+            recipe_id__in=recipe_ids).values_list('recipe_id', 'tag_id'):
+        tags[recipe_id].append(tag_id)
+    vectors.update({
+        recipe_id: vectors.embed(ingredients[recipe_id], tags[recipe_id])
+        if ingredients[recipe_id] or tags[recipe_id] else None
+        for recipe_id in recipe_ids
+    }, watermark)
+
+
+_vectors = None
+_vectors_version = None
+_lock = Lock()
+
+
+def get_recipe_vectors():
+    # Векторы строятся один раз, дополняются при смене версии состава
+    # рецептов и сливаются с overlay без чтения всей БД
+    global _vectors, _vectors_version
+    version = get_recipe_matrix_version()
+    if _vectors is None or _vectors_version != version:
+        with _lock:
+            if _vectors is None:
+                _vectors = build_recipe_vectors()
+            elif _vectors_version != version:
+                refresh_recipe_vectors(_vectors)
+                if (len(_vectors.overlay) + len(_vectors.stale_rows)
+                        > settings.RECIPE_MATRIX_MAX_CHANGES):
+                    _vectors = _vectors.compacted()
+            _vectors_version = version
+    return _vectors
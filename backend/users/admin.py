@@ -3,4 +3,10 @@ from django.contrib import admin
 from .models import Subscription, User
 
 admin.site.register(Subscription)
-admin.site.register(User)
+
+
+@admin.register(User)
+class UserAdmin(admin.ModelAdmin):
+    list_display = ("id", "username", "email", "first_name", "last_name",
+                    "subscribers_count")
+    search_fields = ("username", "email")
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.16 on 2026-10-18 07:50
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicates(apps, schema_editor):
+    # Оставляем самую раннюю подписку из каждой группы дубликатов
+    subscription = apps.get_model('users', 'Subscription')
+    duplicates = subscription.objects.values('user', 'author').order_by(
+    ).annotate(min_id=Min('id'), count=Count('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        subscription.objects.filter(
+            user=duplicate['user'], author=duplicate['author'],
+        ).exclude(id=duplicate['min_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='subscription',
+            constraint=models.UniqueConstraint(fields=('user', 'author'), name='unique_subscription'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.16 on 2026-10-18 07:52
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_counters(apps, schema_editor):
+    # Счетчики существующих пользователей, как в rebuild_counters
+    Subscription = apps.get_model('users', 'Subscription')
+    apps.get_model('users', 'User').objects.update(
+        subscribers_count=Coalesce(Subquery(
+            Subscription.objects.filter(author=OuterRef('pk')).order_by(
+            ).values('author').annotate(count=Count('pk')).values('count')
+        ), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_unique_constraints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='subscribers_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Количество подписчиков'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -2,7 +2,26 @@ from django.contrib.auth.models import AbstractUser
 from django.db import models
 
 
-class User(AbstractUser):
+class CountersMixin:
+    # Счетчики меняются только атомарными F()-обновлениями, поэтому
+    # обычное сохранение объекта не должно перезаписывать их старыми
+    # значениями
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if (self.pk is not None and not self._state.adding
+                and kwargs.get('update_fields') is None):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.counter_fields
+            ]
+        super().save(*args, **kwargs)
+
+
+class User(CountersMixin, AbstractUser):
+    counter_fields = ('subscribers_count',)
+
     email = models.EmailField(
         max_length=254,
         unique=True,
@@ -30,6 +49,16 @@ class User(AbstractUser):
         verbose_name='Пароль',
         help_text='Пароль',
     )
+    subscribers_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Количество подписчиков',
+    )
+    # Учитывается в Last-Modified рецептов автора
+    updated_at = models.DateTimeField(
+        verbose_name='Дата изменения',
+        auto_now=True,
+    )
 
     def __str__(self):
         return self.username
@@ -52,6 +81,12 @@ class Subscription(models.Model):
     class Meta:
         verbose_name = 'Подписка'
         verbose_name_plural = 'Подписки'
+        constraints = (
+            models.UniqueConstraint(
+                fields=('user', 'author'),
+                name='unique_subscription',
+            ),
+        )
 
     def __str__(self):
         return f'{self.user} подписан на {self.author}'